@@ -0,0 +1,301 @@
+'''
+    load test of every route of the API, run in-process against mongomock
+    (default) or a local mongod, e.g. BENCH_MONGO_URI=mongodb://localhost/postsbench
+
+    seeds users with thousands of likes, a zipf distribution of hashtags with
+    a few viral ones and popular posts snapshared by many users, then sends
+    `--requests` requests per route from `--concurrency` concurrent clients
+    and writes throughput and p50/p99 latency per route as JSON. with
+    `--compare` the run fails when a route got slower than the given results
+    by more than `--tolerance`.
+
+    python -m bench.api [--scale 1] [--requests 50] [--concurrency 8] [--out bench-results.json]
+                        [--compare previous.json] [--tolerance 0.25]
+'''
+import os
+os.environ.setdefault("DD_TRACE_ENABLED", "false")
+URI = os.environ.get("BENCH_MONGO_URI", "mongomock://localhost/postsbench")
+os.environ["POSTS_DB_URI"] = URI # what the app connects to on startup
+os.environ["POSTS_DB_ENSURE_INDEXES"] = "0" # created by connect() below
+
+from src import database, main, migrations, models, trending
+from src.trending import bucket_of
+from bson import ObjectId
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+import argparse
+import asyncio
+import httpx
+import json
+import mongoengine
+import numpy as np
+import random
+import sys
+import time
+
+HASHTAGS = [f"#tag{i}" for i in range(200)]
+NEEDS_MONGOD = {"GET /posts/search"} # $text is not implemented by mongomock
+
+
+def connect():
+    mongoengine.disconnect()
+    database.connect() # same client the app gets on startup
+    for document in models.DOCUMENTS:
+        document.drop_collection()
+        # mongomock scans on every query anyway and checks unique indexes with a
+        # scan per insert, only the one the deletion jobs rely on is kept there
+        if not URI.startswith("mongomock") or document is models.UserDeletion:
+            document.ensure_indexes()
+
+
+def seed(scale: int, rng: random.Random):
+    '''
+        users: u0..uN. u0..u4 liked thousands of posts. posts spread over the
+        last week, hashtags following a zipf law (#tag0 is viral). the most
+        liked posts are snapshared by a good share of the users.
+    '''
+    now = datetime.utcnow()
+    users = [f"u{i}" for i in range(200 * scale)]
+    weights = np.array([1 / (rank + 1) for rank in range(len(HASHTAGS))])
+    weights /= weights.sum()
+    np_rng = np.random.default_rng(rng.getrandbits(32))
+
+    posts = []
+    for uid in users:
+        for _ in range(20):
+            k = rng.choice((0, 1, 1, 2, 3))
+            hashtags = list(dict.fromkeys(np_rng.choice(HASHTAGS, size=k, p=weights).tolist()))
+            posts.append(models.Post(
+                id=ObjectId(),
+                uid=uid,
+                text=f"post of {uid} {' '.join(hashtags)}",
+                hashtags=hashtags,
+                media_uri=[f"https://cdn.snapmsg.com/{uid}/{len(posts)}.png"] if rng.random() < 0.3 else [],
+                is_private=rng.random() < 0.1,
+                timestamp=now - timedelta(seconds=rng.randint(0, 7 * 24 * 3600)),
+            ))
+    pids = [post.id for post in posts]
+
+    likes, favs, shares = set(), set(), set()
+    for heavy in users[:5]:
+        likes.update((heavy, pid) for pid in rng.sample(pids, min(2000 * scale, len(pids))))
+    for uid in users:
+        likes.update((uid, pid) for pid in rng.sample(pids, 20))
+        favs.update((uid, pid) for pid in rng.sample(pids, 10))
+    popular = Counter(pid for _, pid in likes).most_common(20)
+    for pid, _ in popular:
+        shares.update((uid, pid) for uid in rng.sample(users, len(users) // 4))
+
+    like_count = Counter(pid for _, pid in likes)
+    share_count = Counter(pid for _, pid in shares)
+    for post in posts:
+        post.likes = like_count[post.id]
+        post.snapshares = share_count[post.id]
+    models.Post._get_collection().insert_many([post.to_mongo() for post in posts])
+    by_id = {post.id: post for post in posts}
+    models.SnapShare._get_collection().insert_many([
+        models.SnapShare(uid=uid, post=by_id[pid], # private, as create_snapshare makes them
+                         timestamp=by_id[pid].timestamp + timedelta(minutes=rng.randint(1, 600))).to_mongo()
+        for uid, pid in shares
+    ])
+    models.Interaction._get_collection().insert_many(
+        [models.Interaction(uid=uid, post=pid, kind='like', timestamp=now).to_mongo() for uid, pid in likes] +
+        [models.Interaction(uid=uid, post=pid, kind='fav', timestamp=now).to_mongo() for uid, pid in favs]
+    )
+    models.User._get_collection().insert_many([{'uid': uid} for uid in users])
+    migrations.backfill_post_stats()
+
+    mentions = Counter(
+        (hashtag, bucket_of(post.timestamp))
+        for post in posts if post.timestamp > now - trending.WINDOW for hashtag in post.hashtags
+    )
+    models.TopicBucket._get_collection().bulk_write([
+        UpdateOne({'topic': topic, 'bucket': bucket}, {'$inc': {'count': n}}, upsert=True)
+        for (topic, bucket), n in mentions.items()
+    ])
+    print(f"[INFO] seeded {len(users)} users, {len(posts)} posts, {len(likes)} likes, "
+          f"{len(favs)} favs, {len(shares)} snapshares")
+    return {
+        'users': users,
+        'pids': [str(pid) for pid in pids],
+        'popular': [str(pid) for pid, _ in popular],
+        'owner': {str(post.id): post.uid for post in posts},
+    }
+
+
+def scenarios(data, n: int, rng: random.Random):
+    '''
+        (name, method, request(i) -> (url, kwargs), accepted statuses). routes
+        that write get their own targets per request, and the ones undoing a
+        write (unlike, unfav...) run after it on the same targets
+    '''
+    users, pids, popular, owner = data['users'], data['pids'], data['popular'], data['owner']
+    user = lambda i: users[i % len(users)]
+    some = lambda i: pids[(i * 7919) % len(pids)]
+    fresh = [(f"bench{i}", pid) for i, pid in enumerate(rng.sample(pids, n))] # users without interactions
+    doomed = rng.sample(pids, n)
+    heavy = users[:5]
+    today = datetime.utcnow().date()
+    cursors = {}
+
+    def next_page(i):
+        params = {'limit': 20}
+        if cursors.get('feed'):
+            params['cursor'] = cursors['feed']
+        return "/posts", {'params': params}
+
+    def new_post(i):
+        tags = rng.sample(HASHTAGS[:10], 2)
+        return "/posts", {'json': {'uid': user(i), 'text': f"bench {' '.join(tags)}", 'hashtags': tags, 'is_private': False}}
+
+    def bulk(i):
+        return "/posts/bulk", {'json': [new_post(i * 50 + j)[1]['json'] for j in range(50)]}
+
+    return [
+        ("GET /", 'GET', lambda i: ("/", {}), {200}),
+        ("GET /health", 'GET', lambda i: ("/health", {}), {200}),
+        ("GET /ready", 'GET', lambda i: ("/ready", {}), {200}),
+        ("GET /posts", 'GET', lambda i: ("/posts", {}), {200}),
+        ("GET /posts?cursor", 'GET', next_page, {200}),
+        ("GET /posts?uid", 'GET', lambda i: ("/posts", {'params': {'uid': [user(i)]}}), {200}),
+        ("GET /posts?uid&fields (covered)", 'GET', lambda i: ("/posts", {'params': {'uid': [user(i)], 'fields': ['pid', 'timestamp']}}), {200}),
+        ("GET /posts?hashtags (viral)", 'GET', lambda i: ("/posts", {'params': {'hashtags': ['#tag0']}}), {200}),
+        ("GET /posts?viewer", 'GET', lambda i: ("/posts", {'params': {'uid': users[i % 50:i % 50 + 5], 'viewer': heavy[i % 5]}}), {200}),
+        ("GET /posts/search", 'GET', lambda i: ("/posts/search", {'params': {'q': 'tag1'}}), {200}),
+        ("GET /posts/{pid}", 'GET', lambda i: (f"/posts/{some(i)}", {}), {200}),
+        ("POST /posts", 'POST', new_post, {201}),
+        ("POST /posts/bulk (50)", 'POST', bulk, {201}),
+        ("PATCH /posts/{pid}", 'PATCH', lambda i: (f"/posts/{some(i)}", {'json': {'text': f"edited {i}"}}), {200}),
+        ("POST /posts/moderation", 'POST', lambda i: ("/posts/moderation", {'json': { # blocks then unblocks a user
+            'is_blocked': i % 2 == 0, 'uid': user(len(users) // 2 + i // 2)}}), {200}),
+        ("GET /posts/{uid}/recommended", 'GET', lambda i: (f"/posts/{user(i)}/recommended", {}), {200}),
+        ("POST /posts/{uid}/likes/{pid}", 'POST', lambda i: ("/posts/{}/likes/{}".format(*fresh[i]), {}), {200}),
+        ("POST /posts/{uid}/likes/{pid} (viral)", 'POST', lambda i: (f"/posts/bench-viral{i}/likes/{popular[0]}", {}), {200}),
+        ("GET /posts/{uid}/likes/{pid}", 'GET', lambda i: ("/posts/{}/likes/{}".format(*fresh[i]), {}), {200}),
+        ("DELETE /posts/{uid}/likes/{pid}", 'DELETE', lambda i: ("/posts/{}/likes/{}".format(*fresh[i]), {}), {200}),
+        ("POST /posts/{uid}/favs/{pid}", 'POST', lambda i: ("/posts/{}/favs/{}".format(*fresh[i]), {}), {200}),
+        ("GET /posts/{uid}/favs/{pid}", 'GET', lambda i: ("/posts/{}/favs/{}".format(*fresh[i]), {}), {200}),
+        ("GET /posts/{uid}/favs", 'GET', lambda i: (f"/posts/{user(i)}/favs", {}), {200}),
+        ("DELETE /posts/{uid}/favs/{pid}", 'DELETE', lambda i: ("/posts/{}/favs/{}".format(*fresh[i]), {}), {200}),
+        ("GET /posts/{uid}/author/{pid}", 'GET', lambda i: (f"/posts/{owner[some(i)]}/author/{some(i)}", {}), {200}),
+        ("GET /posts/{uid}/flags", 'GET', lambda i: (f"/posts/{heavy[i % 5]}/flags", {'params': {'pid': rng.sample(pids, 100)}}), {200}),
+        ("POST /posts/{uid}/snapshares/{pid}", 'POST', lambda i: ("/posts/{}/snapshares/{}".format(*fresh[i]), {}), {200}),
+        ("GET /posts/{uid}/snapshares/{pid}", 'GET', lambda i: ("/posts/{}/snapshares/{}".format(*fresh[i]), {}), {200}),
+        ("GET /posts/{uid}/snapshares/", 'GET', lambda i: (f"/posts/{user(i)}/snapshares/", {}), {200}),
+        ("DELETE /posts/{uid}/snapshares/{pid}", 'DELETE', lambda i: ("/posts/{}/snapshares/{}".format(*fresh[i]), {}), {200}),
+        ("GET /trendings", 'GET', lambda i: ("/trendings", {}), {200}),
+        ("GET /posts/{uid}/stats", 'GET', lambda i: (f"/posts/{user(i)}/stats", {'params': {
+            'start': str(today - timedelta(days=30)), 'end': str(today)}}), {200}),
+        ("GET /posts/{uid}/export", 'GET', lambda i: (f"/posts/{user(i)}/export", {}), {200}),
+        ("DELETE /posts/{pid}", 'DELETE', lambda i: (f"/posts/{doomed[i]}", {}), {200, 400}), # may be gone with its author
+        ("DELETE /posts/users/{uid}", 'DELETE', lambda i: (f"/posts/users/{users[-1 - i % 10]}", {}), {202, 400}),
+        ("GET /posts/users/{uid}/deletion", 'GET', lambda i: (f"/posts/users/{users[-1 - i % 10]}/deletion", {}), {200}),
+    ], cursors
+
+
+async def run(client, scenario, n: int, concurrency: int, cursors):
+    name, method, request, accepted = scenario
+    latencies, errors, statuses = [], 0, Counter()
+    queue = iter(range(n))
+
+    async def worker():
+        nonlocal errors
+        for i in queue:
+            url, kwargs = request(i)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] += 1
+            if response.status_code not in accepted:
+                errors += 1
+            if "cursor" in name:
+                cursors['feed'] = response.headers.get("x-next-cursor")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    ms = np.array(latencies) * 1000
+    return {
+        'requests': n,
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'rps': round(n / elapsed, 1),
+        'mean_ms': round(float(ms.mean()), 2),
+        'p50_ms': round(float(np.percentile(ms, 50)), 2),
+        'p99_ms': round(float(np.percentile(ms, 99)), 2),
+    }
+
+
+async def bench(args):
+    rng = random.Random(args.seed)
+    connect()
+    data = seed(args.scale, rng)
+    results = {}
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False) # errors are counted as 500s
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await main.app.state.warmup # measured as a ready pod
+            cases, cursors = scenarios(data, args.requests, rng)
+            for scenario in cases:
+                if args.only and args.only not in scenario[0]:
+                    continue
+                if scenario[0] in NEEDS_MONGOD and URI.startswith("mongomock"):
+                    print(f"{scenario[0]:42} skipped on mongomock")
+                    continue
+                results[scenario[0]] = result = await run(client, scenario, args.requests, args.concurrency, cursors)
+                print(f"{scenario[0]:42} {result['rps']:8.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+                      f"p99 {result['p99_ms']:8.2f} ms  errors {result['errors']}")
+    return results
+
+
+def compare(results, previous, tolerance: float):
+    # routes whose p50 or p99 grew more than `tolerance` over the previous run
+    regressions = []
+    for name, result in results.items():
+        before = previous.get('routes', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]}")
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="posts API load test")
+    parser.add_argument("--scale", type=int, default=1, help="data size multiplier (200 users, 4000 posts per unit)")
+    parser.add_argument("--requests", type=int, default=50, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", help="run only the routes whose name contains this")
+    parser.add_argument("--out", default="bench-results.json")
+    parser.add_argument("--compare", help="results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    results = asyncio.run(bench(args))
+    with open(args.out, "w") as out:
+        json.dump({
+            'created': datetime.utcnow().isoformat(),
+            'mongo': URI.split("://")[0],
+            'scale': args.scale,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'routes': results,
+        }, out, indent=2)
+    print(f"[INFO] results written to {args.out}")
+
+    failed = [name for name, result in results.items() if result['errors']]
+    if failed:
+        print(f"[ERROR] unexpected statuses on: {', '.join(failed)}")
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(results, json.load(previous), args.tolerance)
+        for regression in regressions:
+            print(f"[ERROR] regression {regression}")
+        failed += regressions
+    sys.exit(1 if failed else 0)
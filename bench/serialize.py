@@ -0,0 +1,91 @@
+'''
+    CPU cost of rendering one 100 item page: the old path (pydantic models
+    built in crud, then FastAPI's jsonable_encoder + JSONResponse) against
+    serialize.items. checks first that both give the same bytes.
+
+    python -m bench.serialize [pages]
+'''
+from src import serialize
+from src.models import PostResponse, PostViewResponse, SnapShareResponse, SnapShareViewResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from bson import ObjectId
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+
+PAGE = 100
+
+
+def fake_post(i: int, now: datetime):
+    post = {
+        '_id': ObjectId(),
+        '_cls': 'BasePost.Post',
+        'uid': f"user-{i % 7}",
+        'text': random.choice(["hola mundo #snap", "ünïcödé ✨ \"quoted\" \\ text", "a" * 300, "line\nbreak\ttab"]),
+        'hashtags': random.sample(["#snap", "#msg", "#fiuba", "#ñandú"], k=i % 3),
+        'is_private': False,
+        'is_blocked': False,
+        'likes': random.randint(0, 10 ** 6),
+        'snapshares': random.randint(0, 1000),
+        'timestamp': now - timedelta(seconds=i, microseconds=random.choice([0, 1, 759000])),
+    }
+    if i % 4:
+        post['media_uri'] = [f"https://cdn.example.com/{i}.png"]
+    return post
+
+
+def fake_page(viewer: bool):
+    now = datetime.utcnow().replace(microsecond=0)
+    docs = []
+    for i in range(PAGE):
+        doc = fake_post(i, now)
+        if i % 5 == 0: # snapshare of another post
+            doc = {
+                '_id': ObjectId(), '_cls': 'BasePost.SnapShare', 'uid': f"user-{i % 3}", 'post': doc,
+                'is_private': False, 'is_blocked': False, 'timestamp': now - timedelta(seconds=i),
+            }
+        if viewer:
+            doc['flags'] = {'liked': i % 2 == 0, 'faved': i % 3 == 0, 'snapshared': False, 'author': i == 1}
+        docs.append(doc)
+    return docs
+
+
+def old_render(docs, viewer: bool) -> bytes:
+    # what crud.read_posts + FastAPI did before
+    models = []
+    for doc in docs:
+        if 'post' in doc:
+            models.append(SnapShareViewResponse(**doc) if viewer else SnapShareResponse(**doc))
+        else:
+            models.append(PostViewResponse(**doc) if viewer else PostResponse(**doc))
+    content = [model.model_dump(by_alias=True) for model in models]
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def cpu_per_page(render, pages: int) -> float:
+    start = time.process_time()
+    for _ in range(pages):
+        render()
+    return (time.process_time() - start) / pages * 1e6 # us
+
+
+def main(pages: int):
+    encoders = [('json', None)] + ([('orjson', serialize.orjson)] if serialize.orjson else [])
+    for viewer in (False, True):
+        docs = fake_page(viewer)
+        old = old_render(docs, viewer)
+        old_us = cpu_per_page(lambda: old_render(docs, viewer), pages)
+        print(f"page of {PAGE} {'with' if viewer else 'without'} viewer flags: old path {old_us:8.0f} us")
+
+        for name, module in encoders:
+            serialize.orjson = module
+            assert serialize.items(docs) == old, f"{name} output differs from the old path"
+            new_us = cpu_per_page(lambda: serialize.items(docs), pages)
+            print(f"    serialize.items ({name:6}) {new_us:8.0f} us  {old_us / new_us:5.1f}x")
+        serialize.orjson = encoders[-1][1]
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
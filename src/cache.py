@@ -0,0 +1,152 @@
+from .database import primary_reads
+from .metrics import statsd
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterable
+import os
+import threading
+import time
+
+'''
+    in-process read-through caches
+'''
+
+
+class LRUCache:
+    '''
+        size and ttl bounded LRU, safe to share between the db worker threads.
+        concurrent misses on the same key are coalesced: the first caller
+        loads it, the others wait for its result. cached values are shared,
+        callers must not mutate them.
+
+        read-your-writes requests (database.primary_reads) neither read nor
+        fill it: values are loaded by relaxed reads, possibly from a secondary.
+
+        hits, misses, coalesced misses and evictions are sent to statsd as
+        `<name>.cache.<event>`
+    '''
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict() # key -> (expires at, value)
+        self._loading: Dict[Hashable, Future] = {}
+        self._generation = 0 # bumped on every invalidation
+        self._lock = threading.Lock()
+
+    def _count(self, event: str, n: int = 1):
+        if n:
+            statsd.increment(f"{self.name}.cache.{event}", value=n)
+
+    def _lookup(self, key: Hashable):
+        # under the lock
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _store(self, key: Hashable, value: Any):
+        # under the lock
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        evicted = 0
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            evicted += 1
+        self._count("eviction", evicted)
+
+    def get(self, key: Hashable, load: Callable[[Hashable], Any]) -> Any:
+        if primary_reads.get():
+            return load(key)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self._count("hit")
+                return entry[1]
+            future = self._loading.get(key)
+            leader = future is None
+            if leader:
+                future = self._loading[key] = Future()
+
+        if not leader:
+            self._count("coalesced")
+            return future.result()
+
+        self._count("miss")
+        try:
+            value = load(key)
+        except BaseException as exc:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            # skip storing if the key was invalidated while loading
+            if self._loading.get(key) is future:
+                del self._loading[key]
+                self._store(key, value)
+        future.set_result(value)
+        return value
+
+    def get_many(self, keys: Iterable[Hashable], load: Callable[[list], Dict[Hashable, Any]]) -> Dict[Hashable, Any]:
+        '''
+            cached values for `keys`, loading all the missing ones with a single
+            `load(missing)` call (keys it does not return are left out)
+        '''
+        if primary_reads.get():
+            return load(list(keys))
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                entry = self._lookup(key)
+                if entry is not None:
+                    found[key] = entry[1]
+                else:
+                    missing.append(key)
+        self._count("hit", len(found))
+        self._count("miss", len(missing))
+
+        if missing:
+            generation = self._generation
+            loaded = load(missing)
+            with self._lock:
+                if generation == self._generation: # nothing invalidated meanwhile
+                    for key, value in loaded.items():
+                        self._store(key, value)
+            found.update(loaded)
+        return found
+
+    def put(self, key: Hashable, value: Any):
+        if primary_reads.get():
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, *keys: Hashable):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+                self._loading.pop(key, None) # an in-flight load will not be stored
+
+
+# post documents by ObjectId, see crud.read_post/fetch_posts
+posts = LRUCache(
+    "posts",
+    maxsize=int(os.environ.get("POSTS_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("POSTS_CACHE_TTL", 5)),
+)
+
+
+# rendered /trendings pages by (ranking epoch, limit, page, cursor), see crud.get_trending_topics
+trendings = LRUCache(
+    "trendings",
+    maxsize=int(os.environ.get("TRENDINGS_CACHE_SIZE", 1000)),
+    ttl=float(os.environ.get("TRENDINGS_CACHE_TTL", 120)), # older epochs are never hit again
+)
@@ -0,0 +1,151 @@
+from .database import offload
+from . import cache
+from .models import Post, PostStats
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Tuple, Any, Iterable
+from bson import ObjectId
+import asyncio
+import os
+import threading
+
+'''
+    counters: post likes/snapshares and the PostStats daily rollups
+
+    by default every delta is applied on the spot with an atomic $inc. with
+    POSTS_COUNTERS_MODE=coalesce deltas are summed in memory and written as
+    a single bulk of $inc every POSTS_COUNTERS_FLUSH seconds, so a viral post
+    takes one write per interval instead of one per like (counts shown may
+    lag by up to one interval).
+
+    cached copies of a post are dropped once its counters are written. deltas
+    of a flush that fails are put back and retried on the next one.
+'''
+MODE = os.environ.get("POSTS_COUNTERS_MODE", "direct")
+FLUSH_INTERVAL = float(os.environ.get("POSTS_COUNTERS_FLUSH", 0.5)) # seconds
+
+_lock = threading.Lock()
+_pending: Dict[Tuple[str, Any, str], int] = defaultdict(int) # (target, key, field) -> delta
+
+
+def day_of(timestamp: datetime) -> datetime:
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def post_update(pid: ObjectId, inc: Dict[str, int]) -> UpdateOne:
+    return UpdateOne({'_id': pid}, {'$inc': inc})
+
+
+def stats_update(key: Tuple[str, datetime], inc: Dict[str, int]) -> UpdateOne:
+    uid, day = key
+    return UpdateOne({'uid': uid, 'day': day}, {'$inc': inc}, upsert=True)
+
+
+def write(post_ops, stats_ops):
+    if post_ops:
+        Post._get_collection().bulk_write(post_ops, ordered=False)
+    if stats_ops:
+        PostStats._get_collection().bulk_write(stats_ops, ordered=False)
+
+
+def _apply(target: str, key: Any, deltas: Dict[str, int]):
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    if MODE != "coalesce":
+        if target == 'post':
+            write([post_update(key, deltas)], [])
+            cache.posts.invalidate(key)
+        else:
+            write([], [stats_update(key, deltas)])
+        return
+    with _lock:
+        for field, delta in deltas.items():
+            _pending[(target, key, field)] += delta
+
+
+def add(pid: str, field: str, delta: int):
+    # $inc a counter of a post
+    _apply('post', ObjectId(pid), {field: delta})
+
+
+def add_stats(uid: str, timestamp: datetime, **deltas: int):
+    # $inc the rollup of `uid` for the day of `timestamp`
+    _apply('stats', (uid, day_of(timestamp)), deltas)
+
+
+def add_many(rows: Iterable[Tuple[ObjectId, Dict[str, int]]]):
+    # counter deltas of many posts, summed per post and written with a single bulk
+    totals = defaultdict(lambda: defaultdict(int))
+    for pid, deltas in rows:
+        for field, delta in deltas.items():
+            totals[pid][field] += delta
+    if MODE == "coalesce":
+        for pid, deltas in totals.items():
+            _apply('post', pid, deltas)
+        return
+    write([post_update(pid, dict(deltas)) for pid, deltas in totals.items()], [])
+    cache.posts.invalidate(*totals)
+
+
+def add_stats_many(rows: Iterable[Tuple[str, datetime, Dict[str, int]]]):
+    # many rollup deltas at once, summed per (uid, day) and written with a single bulk
+    totals = defaultdict(lambda: defaultdict(int))
+    for uid, timestamp, deltas in rows:
+        for field, delta in deltas.items():
+            totals[(uid, day_of(timestamp))][field] += delta
+    if MODE == "coalesce":
+        for key, deltas in totals.items():
+            _apply('stats', key, deltas)
+        return
+    write([], [stats_update(key, dict(deltas)) for key, deltas in totals.items()])
+
+
+def requeue(target: str, incs: Dict[Any, Dict[str, int]]):
+    # deltas of a failed flush, back in the pending buffer
+    with _lock:
+        for key, inc in incs.items():
+            for field, delta in inc.items():
+                _pending[(target, key, field)] += delta
+
+
+def flush():
+    global _pending
+    with _lock:
+        pending, _pending = _pending, defaultdict(int)
+
+    posts, stats = defaultdict(dict), defaultdict(dict) # one $inc per document
+    for (target, key, field), delta in pending.items():
+        if delta:
+            (posts if target == 'post' else stats)[key][field] = delta
+
+    failed = None
+    for target, incs, update, document in (('post', posts, post_update, Post), ('stats', stats, stats_update, PostStats)):
+        if not incs:
+            continue
+        keys = list(incs)
+        try:
+            document._get_collection().bulk_write([update(key, incs[key]) for key in keys], ordered=False)
+        except BulkWriteError as exc:
+            # the other $inc were applied, only the failed ones are retried
+            requeue(target, {keys[error['index']]: incs[keys[error['index']]] for error in exc.details['writeErrors']})
+            failed = failed or exc
+        except Exception as exc:
+            # nothing acknowledged (e.g. a step-down): the whole bulk is retried
+            requeue(target, incs)
+            failed = failed or exc
+    cache.posts.invalidate(*posts)
+    if failed:
+        raise failed
+
+
+async def run():
+    # flush loop, started on app startup when coalescing is on
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await offload(flush)()
+        except Exception as exc:
+            print(f"[ERROR] counters flush failed, retrying on the next one: {exc}")
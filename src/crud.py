@@ -1,25 +1,39 @@
-# from .database import db
+from .database import offload, relaxed, relaxed_collection
 from .models import (
     User, 
+    Interaction,
+    PostStats,
+    UserDeletion,
     BasePost, 
     Post, 
     SnapShare,
     PostCreate, 
     PostQuery, 
     PostUpdate, 
+    PostModeration,
     PostResponse,
-    SnapShareResponse,
-    TrendingTopic,
-    TopicMention,
 )
-from typing import List, Dict, Any 
+from . import cache
+from . import counters
+from . import deletion
+from . import recommend
+from . import serialize
+from . import timeline
+from . import trending
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from bson import ObjectId
+from bson.errors import InvalidId
 from collections.abc import Iterable
 from mongoengine.queryset.visitor import Q
-from mongoengine import DoesNotExist
+from mongoengine import DoesNotExist, NotUniqueError, ValidationError
 
+from pydantic import ValidationError as PydanticValidationError
+from pymongo.errors import BulkWriteError
 from datetime import datetime, timedelta
 
+import base64
 import logging
+import os
 
 
 class CRUDException(Exception):
@@ -33,46 +47,241 @@ class CRUDException(Exception):
 
 
 
-def get_mongo_query(post_query: PostQuery) -> Dict[str, Any]:
-    query = Q() 
-    for k, v in post_query.model_dump().items():
-        if isinstance(v, str):
-            query &= Q(**{f"{k}__contains" : v})
-        elif isinstance(v, list):
-            expr = map(lambda item: f"Q({k}__contains='{item}')", v)
-            query &= (eval(" | ".join(expr)))
-        else:
-            # ignore other type than list, str or bool
-            pass
-    return query 
+EPOCH = datetime(1970, 1, 1)
 
 
-async def get_user(uid: str):
+def encode_cursor(timestamp: datetime, oid: ObjectId) -> str:
+    # opaque keyset cursor: (timestamp in ms, _id) of the last returned document
+    millis = (timestamp - EPOCH) // timedelta(milliseconds=1)
+    return base64.urlsafe_b64encode(f"{millis}:{oid}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
     try:
-        user = User.objects.get(uid=uid)
-    except DoesNotExist:
-        print("[DEBUG] user does not exist")
-        user = User(uid=uid).save() # init one if does not exist
-    return user 
+        millis, oid = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+    except (ValueError, InvalidId):
+        raise CRUDException("invalid cursor")
+
+
+def paginate(queryset, limit: int, page: int = 0, cursor: Optional[str] = None):
+    '''
+        newest first page of `queryset`. with a cursor the page is a range scan
+        over (timestamp, _id) starting right after it, so every page costs the
+        same; `page` offsets are still accepted for older clients
+    '''
+    if limit == 0:
+        return queryset.none()
+    if cursor:
+        timestamp, oid = decode_cursor(cursor)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=oid))
+    else:
+        queryset = queryset.skip(limit * page)
+    return queryset.order_by('-timestamp', '-id').limit(limit)
+
+
+def next_cursor(docs: List[Dict[str, Any]], limit: int) -> Optional[str]:
+    # a full page means there may be more documents after the last one
+    if limit and len(docs) == limit:
+        return encode_cursor(docs[-1]['timestamp'], docs[-1]['_id'])
+    return None
+
+
+def projection(fields: List[str]) -> List[str]:
+    # `fields=` of the list endpoints (PostResponse field names) to .only() arguments
+    unknown = set(fields) - set(PostResponse.model_fields)
+    if unknown:
+        raise CRUDException(f"unknown fields: {', '.join(sorted(unknown))}")
+    return ['id' if field == 'pid' else field for field in fields]
+
+
+COVERED_FIELDS = {'pid', 'uid', 'timestamp'}
+
+
+def read_covered(filters: Dict[str, Any], limit: int, page: int, cursor: Optional[str]) -> List[Dict[str, Any]]:
+    '''
+        covered query for pages of only pids/uids/timestamps by author: the
+        filter and the projection only touch keys of the (uid, timestamp, _id,
+        is_private, is_blocked) index, so mongo answers from the index alone.
+        raw pymongo, mongoengine would add a _cls filter and projection.
+        only for public pages: snapshares can't be told apart here, and the
+        other path renders them with their shared post. they are always
+        private, so public pages hold posts only and both paths give the same
+        items
+    '''
+    if limit == 0:
+        return []
+    query = {'uid': {'$in': filters['uid']}, 'is_private': False}
+    if not filters.get('blocked'):
+        query['is_blocked'] = False
+    if cursor:
+        timestamp, oid = decode_cursor(cursor)
+        query['$or'] = [{'timestamp': {'$lt': timestamp}}, {'timestamp': timestamp, '_id': {'$lt': oid}}]
+    found = relaxed_collection(BasePost).find(query, {'_id': 1, 'uid': 1, 'timestamp': 1}) \
+        .sort([('timestamp', -1), ('_id', -1)]).limit(limit)
+    if not cursor:
+        found = found.skip(limit * page)
+    return list(found)
+
+
+def get_mongo_query(post_query: PostQuery) -> Q:
+    '''
+        exact-match clauses only, so every query can be served by an index:
+        uid -> $in over (uid, timestamp, _id), hashtags -> $in over the multikey
+        (hashtags, timestamp, _id), neither -> (timestamp, _id). text is an
+        anchored prefix match applied on top of them
+    '''
+    fields = post_query.model_dump()
+    query = Q()
+    if fields.get('uid'):
+        query &= Q(uid__in=fields['uid'])
+    if fields.get('hashtags'):
+        query &= Q(hashtags__in=fields['hashtags'])
+    if fields.get('text'):
+        query &= Q(text__startswith=fields['text'])
+    if not fields.get('private'):
+        query &= Q(is_private=False) # privates only shown if flag set
+    if not fields.get('blocked'):
+        query &= Q(is_blocked=False) # blocked only shown if flag set
+    return query
+
+
+def add_interaction(uid: str, post: Post, kind: str) -> bool:
+    # insert a like/fav edge, False if it already exists (unique index)
+    try:
+        Interaction(uid=uid, post=post, kind=kind).save()
+    except NotUniqueError:
+        return False
+    return True
+
+
+def remove_interaction(uid: str, post: Post, kind: str) -> bool:
+    return bool(Interaction.objects(uid=uid, post=post, kind=kind).delete())
 
 
-async def create_post(post_create: PostCreate):
+def has_interaction(uid: str, pid: str, kind: str) -> bool:
+    return relaxed(Interaction.objects(uid=uid, post=pid, kind=kind)).only('id').first() is not None
+
+
+def fetch_flags(uid: str, ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, bool]]:
+    '''
+        liked/faved/snapshared/author flags of `uid` for many posts, with one
+        indexed query per collection whatever the number of posts
+    '''
+    flags = {pid: {'liked': False, 'faved': False, 'snapshared': False, 'author': False} for pid in ids}
+    if not ids:
+        return flags
+    for edge in relaxed(Interaction.objects(uid=uid, post__in=ids)).only('post', 'kind').as_pymongo():
+        flags[edge['post']]['liked' if edge['kind'] == 'like' else 'faved'] = True
+    for snapshare in relaxed(SnapShare.objects(uid=uid, post__in=ids)).only('post').as_pymongo():
+        flags[snapshare['post']]['snapshared'] = True
+    for post in relaxed(Post.objects(id__in=ids, uid=uid)).only('id').as_pymongo():
+        flags[post['_id']]['author'] = True
+    return flags
+
+
+def load_posts(ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+    return {post['_id']: post for post in relaxed(Post.objects(id__in=ids)).as_pymongo()}
+
+
+def fetch_posts(ids: Iterable[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+    # many posts keyed by id, the ones not cached are fetched in a single $in round trip
+    ids = list(ids)
+    if not ids:
+        return {}
+    return cache.posts.get_many(ids, load_posts)
+
+
+def resolve_snapshares(posts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+        dereference the `post` of every snapshare in `posts` with one query
+        (snapshares pointing to a post that no longer exists are dropped)
+    '''
+    targets = fetch_posts({post['post'] for post in posts if 'post' in post})
+    resolved = []
+    for post in posts:
+        if 'post' in post:
+            if post['post'] not in targets:
+                continue
+            post['post'] = targets[post['post']]
+        resolved.append(post)
+    return resolved
+
+
+@offload
+def create_post(post_create: PostCreate):
     post = Post(**post_create.model_dump())
     post.save()
-    post.reload() 
-    user = await get_user(post.uid)
-
-    if post.is_private:
-        user.private.append(post)
-    else:
-        user.public.append(post)
-    user.save()
+    counters.add_stats(post.uid, post.timestamp, posts=1)
+    timeline.forget(post.uid)
     return post
 
+
+def validation_detail(exc: Exception) -> str:
+    if isinstance(exc, PydanticValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, err['loc']))}: {err['msg']}" if err['loc'] else err['msg']
+            for err in exc.errors()
+        )
+    return str(exc)
+
+
+@offload
+def create_posts(items: List[Any]) -> Dict[str, Any]:
+    '''
+        bulk insert: every item is validated on its own, the valid ones are
+        written with one unordered insert_many, then stats rollups are
+        updated with one bulk. failed items are reported by their index in
+        `items`
+    '''
+    errors, posts, indexes = [], [], []
+    for i, item in enumerate(items):
+        try:
+            post = Post(**PostCreate.model_validate(item).model_dump())
+            post.validate()
+        except (PydanticValidationError, ValidationError) as exc:
+            errors.append({'index': i, 'detail': validation_detail(exc)})
+            continue
+        posts.append(post)
+        indexes.append(i)
+
+    docs = [post.to_mongo() for post in posts]
+    inserted = set(range(len(docs)))
+    if docs:
+        try:
+            Post._get_collection().insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            for error in exc.details['writeErrors']:
+                inserted.discard(error['index'])
+                errors.append({'index': indexes[error['index']], 'detail': error['errmsg']})
+
+    created = []
+    for i in sorted(inserted):
+        posts[i].id = docs[i]['_id'] # set by insert_many
+        created.append(posts[i])
+    counters.add_stats_many((post.uid, post.timestamp, {'posts': 1}) for post in created)
+    timeline.forget(*{post.uid for post in created})
+    return {
+        'created': len(created),
+        'pids': [str(post.id) for post in created],
+        'hashtags': [hashtag for post in created for hashtag in post.hashtags], # for the trending pipeline
+        'errors': sorted(errors, key=lambda error: error['index']),
+    }
+
   
-async def is_author(uid: str, pid: str):
+@offload
+def get_flags(uid: str, pids: List[str]) -> Dict[str, Dict[str, bool]]:
+    try:
+        ids = [ObjectId(pid) for pid in pids]
+    except InvalidId:
+        raise CRUDException("invalid pid")
+    return {str(pid): flags for pid, flags in fetch_flags(uid, ids).items()}
+
+
+@offload
+def is_author(uid: str, pid: str):
     try: 
-        post = Post.objects(id=pid).get()
+        post = relaxed(Post.objects(id=pid)).only('uid').get()
         if post.uid == uid:
             return True
     except DoesNotExist:
@@ -81,225 +290,391 @@ async def is_author(uid: str, pid: str):
     return False
   
   
-async def read_post(pid: str) -> Dict[str, Any]:
-    return Post.objects.as_pymongo().get(pk=pid)
+@offload
+def read_post(pid: str) -> Dict[str, Any]:
+    try:
+        oid = ObjectId(pid)
+    except InvalidId:
+        raise ValidationError("invalid pid")
+    return cache.posts.get(oid, lambda oid: relaxed(Post.objects).as_pymongo().get(pk=oid))
 
 
-async def read_posts(post_query: PostQuery, limit: int, page: int) -> List[Dict[str, Any]]:
+@offload
+def read_posts(post_query: PostQuery, limit: int, page: int, cursor: Optional[str] = None, 
+               viewer: Optional[str] = None, fields: List[str] = []):
     print(f"[INFO] posts: {post_query.__dict__}")
-    private = post_query.__dict__.pop("private")
-    blocked = post_query.__dict__.pop("blocked")
+    only = projection(fields)
+    filters = post_query.model_dump()
+    if fields and set(fields) <= COVERED_FIELDS and not viewer and filters.get('uid') \
+            and not filters.get('hashtags') and not filters.get('text') and not filters.get('private'):
+        db_posts = read_covered(filters, limit, page, cursor)
+        return db_posts, next_cursor(db_posts, limit)
+
+    if len(filters.get('uid') or []) >= timeline.MIN_AUTHORS and not filters.get('hashtags') \
+            and not filters.get('text') and (cursor or page == 0):
+        # home timeline: merge of per-author range scans, whole documents (trimmed when rendered)
+        after = decode_cursor(cursor) if cursor else None
+        db_posts = timeline.read(filters['uid'], filters.get('private'), filters.get('blocked'), limit, after) \
+            if limit else []
+    else:
+        query = get_mongo_query(post_query)
+        queryset = relaxed(BasePost.objects.filter(query))
+        if only:
+            queryset = queryset.only(*only, 'timestamp', 'post') # cursor, snapshare target
+        db_posts = list(paginate(queryset, limit, page, cursor).as_pymongo())
+    cursor = next_cursor(db_posts, limit)
+
+    db_posts = resolve_snapshares(db_posts)
+
+    if viewer:
+        # embed the viewer flags of each post (of the shared post for snapshares)
+        targets = [post['post']['_id'] if 'post' in post else post['_id'] for post in db_posts]
+        flags = fetch_flags(viewer, targets)
+        for post, target in zip(db_posts, targets):
+            post['flags'] = flags[target]
+    
+    return db_posts, cursor # raw documents, rendered by serialize.items
 
-    FROM, TO = limit * page, limit * (page + 1)
 
+@offload
+def search_posts(text: str, post_query: PostQuery, limit: int, page: int) -> List[Dict[str, Any]]:
+    '''
+        relevance ranked full-text search over text and hashtags, served by the
+        text index and filtered like read_posts (privates, blocked, uid, ...)
+    '''
+    FROM, TO = limit * page, limit * (page + 1)
     query = get_mongo_query(post_query)
-    query &= Q(**{"is_private__in": [False, private]}) # show publics and private if flag set
-    query &= Q(**{"is_blocked__in": [False, blocked]}) # show unblocked and blocked if flag set
-    db_posts = BasePost.objects.filter(query)[FROM:TO].order_by("-timestamp").as_pymongo()
-        
-    posts = []
-
-    # dereference posts
-    for post in db_posts:
-        if 'post' in post:
-            post['post'] = Post.objects.get(id=post['post']).to_mongo().to_dict()
-            posts.append(SnapShareResponse(**post))
-        else:
-            posts.append(PostResponse(**post))
-    
-    return posts 
+    db_posts = relaxed(Post.objects.filter(query)).search_text(text).order_by('$text_score')[FROM:TO].as_pymongo()
+    return list(db_posts)
 
 
-async def update_post(pid: str, post: PostUpdate):
+@offload
+def update_post(pid: str, post: PostUpdate):
     try:
-        Post.objects(id=pid).get().update(**post.model_dump())
+        db_post = Post.objects(id=pid).only('uid').get()
     except DoesNotExist:
         raise CRUDException("post doesnt exist")
-
-
-async def delete_post(pid: str):
+    db_post.update(**post.model_dump())
+    cache.posts.invalidate(ObjectId(pid))
+    timeline.forget(db_post.uid)
+
+
+MODERATION_CHUNK = int(os.environ.get("POSTS_MODERATION_CHUNK", 1000))
+
+
+@offload
+def moderate_posts(moderation: PostModeration) -> Dict[str, int]:
+    '''
+        block/unblock the posts matching all the criteria of `moderation` and
+        their snapshares. MODERATION_CHUNK posts at a time: their ids are read
+        over the index of the criteria, then one update_many for them and one
+        for their snapshares. posts already in that state are left out, so an
+        interrupted or repeated call picks up where it stopped
+    '''
+    print(f"[INFO] moderation: {moderation.model_dump(exclude={'pids'})} pids={len(moderation.pids)}")
+    value = moderation.is_blocked
+    criteria = []
+    if moderation.uid:
+        criteria.append(Q(uid=moderation.uid))
+    if moderation.hashtags:
+        criteria.append(Q(hashtags__in=moderation.hashtags))
+    if moderation.since:
+        criteria.append(Q(timestamp__gte=moderation.since))
+    if moderation.until:
+        criteria.append(Q(timestamp__lt=moderation.until))
+    if not criteria and not moderation.pids:
+        raise CRUDException("no posts selected")
+
+    query = Q(is_blocked__ne=value)
+    for criterion in criteria:
+        query &= criterion
+    selections = [query]
+    if moderation.pids:
+        try:
+            ids = [ObjectId(pid) for pid in dict.fromkeys(moderation.pids)]
+        except InvalidId:
+            raise CRUDException("invalid pid")
+        selections = [query & Q(id__in=ids[i:i + MODERATION_CHUNK]) for i in range(0, len(ids), MODERATION_CHUNK)]
+
+    posts = BasePost._get_collection()
+    counts = {'posts': 0, 'snapshares': 0}
+    for selection in selections:
+        while True:
+            chunk = list(Post.objects(selection).only('uid').limit(MODERATION_CHUNK).as_pymongo())
+            if not chunk:
+                break
+            ids = [post['_id'] for post in chunk]
+            counts['posts'] += posts.update_many(
+                {'_id': {'$in': ids}}, {'$set': {'is_blocked': value}}
+            ).modified_count
+            counts['snapshares'] += posts.update_many(
+                {'_cls': SnapShare._class_name, 'post': {'$in': ids}, 'is_blocked': {'$ne': value}}, # sparse post index
+                {'$set': {'is_blocked': value}},
+            ).modified_count
+            cache.posts.invalidate(*ids)
+            timeline.forget(*{post['uid'] for post in chunk})
+    return counts
+
+
+@offload
+def delete_post(pid: str):
     try:
         post = Post.objects(id=pid).get()
     except DoesNotExist:
         raise CRUDException("post does not exist")
+
+    # its snapshares go away with it (CASCADE), take them out of the sharers rollups
+    for snapshare in SnapShare.objects(post=post).only('uid', 'timestamp').as_pymongo():
+        counters.add_stats(snapshare['uid'], snapshare['timestamp'], posts=-1)
+    counters.add_stats(post.uid, post.timestamp, posts=-1, likes=-post.likes, snapshares=-post.snapshares)
     post.delete()
+    cache.posts.invalidate(post.id)
+    timeline.forget(post.uid)
 
 
-async def get_recommended(uid: str, limit: int, page: int) -> List[Dict[str, Any]]:
-    return []
+@offload
+def get_recommended(uid: str, limit: int, page: int) -> List[Dict[str, Any]]:
+    return recommend.recommended(uid, limit, page)
 
 
-async def add_favs(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post in user.favs:
+@offload
+def add_favs(uid: str, pid: str):
+    post = Post.objects(id=pid).only('id').get()
+    if not add_interaction(uid, post, 'fav'):
         raise CRUDException("post already in favs")
-    user.favs.append(post)
-    user.save()
-    print(user.to_mongo())
 
     
-async def is_faved(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post in user.favs:
-        return True
-    return False
+@offload
+def is_faved(uid: str, pid: str):
+    return has_interaction(uid, pid, 'fav')
 
  
-async def read_favs(uid: str, limit: int, page: int) -> List[Dict[str, Any]]:
-    FROM, TO = limit * page, limit * (page + 1)
-    user = await get_user(uid)
+@offload
+def read_favs(uid: str, limit: int, page: int, cursor: Optional[str] = None, fields: List[str] = []):
+    '''
+        range scan over the (uid, kind, timestamp) index, most recently faved
+        first. the posts come whole from the post cache, `fields` only trims
+        the response
+    '''
+    projection(fields)
+    edges = paginate(relaxed(Interaction.objects(uid=uid, kind='fav')).only('post', 'timestamp'), limit, page, cursor)
+    edges = list(edges.as_pymongo())
+    posts = fetch_posts(edge['post'] for edge in edges)
     favs = []
 
-    for post in user.favs[FROM:TO]:
-        if post.is_blocked:
+    for edge in edges:
+        post = posts.get(edge['post'])
+        if post is None or post['is_blocked']:
             continue
-        favs.append(post.to_mongo().to_dict())
-    return favs
+        favs.append(post)
+    return favs, next_cursor(edges, limit)
 
 
-async def delete_favs(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post not in user.favs:
+@offload
+def delete_favs(uid: str, pid: str):
+    post = Post.objects(id=pid).only('id').get()
+    if not remove_interaction(uid, post, 'fav'):
         raise CRUDException("post not in favs")
-    user.favs.remove(post)
-    user.save()
 
 
-async def like_post(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post in user.liked:
+@offload
+def like_post(uid: str, pid: str):
+    post = Post.objects(id=pid).only('id', 'uid', 'timestamp').get()
+    if not add_interaction(uid, post, 'like'):
         raise CRUDException("like already exist")
-    
-    post.likes += 1
-    user.liked.append(post)
-    post.save()
-    user.save()
+    counters.add(pid, 'likes', 1)
+    counters.add_stats(post.uid, post.timestamp, likes=1)
 
 
-async def unlike_post(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post not in user.liked:
+@offload
+def unlike_post(uid: str, pid: str):
+    post = Post.objects(id=pid).only('id', 'uid', 'timestamp').get()
+    if not remove_interaction(uid, post, 'like'):
         raise CRUDException("like does not exist")
-
-    post.likes -= 1
-    user.liked.remove(post)
-    post.save()
-    user.save()
+    counters.add(pid, 'likes', -1)
+    counters.add_stats(post.uid, post.timestamp, likes=-1)
 
     
-async def is_liked(uid: str, pid: str):
-    user = await get_user(uid)
-    post = Post.objects(id=pid).get()
-    if post in user.liked:
-        return True
-    return False
+@offload
+def is_liked(uid: str, pid: str):
+    return has_interaction(uid, pid, 'like')
   
 
-async def delete_user(uid: str):
-    try:
-        user = User.objects(uid=uid).get()
-    except DoesNotExist:
+@offload
+def delete_user(uid: str) -> bool:
+    '''
+        queue the deletion of all the posts, snapshares, likes and favs of the
+        user, run in the background by deletion.py. False if it is already
+        in progress
+    '''
+    exists = BasePost.objects(uid=uid).only('id').first() or \
+        Interaction.objects(uid=uid).only('id').first() or \
+        User.objects(uid=uid).only('id').first()
+    if not exists:
         raise CRUDException("user does not exist")
-    # delete all posts with user as author 
-    post = BasePost.objects(uid=uid).delete()
-    user.delete()
+    return deletion.claim(uid) is not None
+
+
+EXPORT_BATCH = int(os.environ.get("POSTS_EXPORT_BATCH", 500))
+
+
+def export_lines(docs, line) -> Iterator[bytes]:
+    # one NDJSON chunk per cursor batch, so at most one batch is held in memory
+    chunk = []
+    for doc in docs:
+        chunk.append(serialize.dumps(line(doc)))
+        if len(chunk) == EXPORT_BATCH:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def export_post(doc: Dict[str, Any]) -> Dict[str, Any]:
+    if 'post' in doc: # snapshares reference the shared post by pid
+        return {
+            'type': 'snapshare',
+            'pid': str(doc['_id']),
+            'uid': doc['uid'],
+            'post': str(doc['post']),
+            'is_private': doc.get('is_private'),
+            'is_blocked': doc.get('is_blocked'),
+            'timestamp': doc['timestamp'].isoformat(),
+        }
+    return {'type': 'post', **serialize.post(doc)}
+
+
+def export_user(uid: str) -> Iterator[bytes]:
+    '''
+        every post, snapshare, like and fav of `uid` as newline delimited JSON,
+        newest first. each collection is read with a single server-side cursor
+        fetching EXPORT_BATCH documents per round trip, so memory stays flat
+        whatever the history size. a plain generator, run by starlette in its
+        thread pool while streaming the response
+    '''
+    posts = BasePost._get_collection().find({'uid': uid}, {'_cls': 0}, batch_size=EXPORT_BATCH) \
+        .sort([('timestamp', -1), ('_id', -1)]) # (uid, timestamp, _id) index
+    yield from export_lines(posts, export_post)
+
+    for kind in ('like', 'fav'):
+        edges = Interaction._get_collection().find({'uid': uid, 'kind': kind}, batch_size=EXPORT_BATCH) \
+            .sort([('timestamp', -1), ('_id', -1)]) # (uid, kind, timestamp, _id) index
+        yield from export_lines(edges, lambda edge: {
+            'type': edge['kind'],
+            'pid': str(edge['post']),
+            'timestamp': edge['timestamp'].isoformat(),
+        })
+
+
+@offload
+def get_user_deletion(uid: str) -> Optional[Dict[str, Any]]:
+    return UserDeletion.objects(uid=uid).exclude('id').as_pymongo().first()
 
     
-async def create_snapshare(uid: str, pid: str):
-    user = await get_user(uid)
-    
+@offload
+def create_snapshare(uid: str, pid: str):
     try:
-        post = Post.objects.get(id=pid)
+        post = Post.objects.only('id', 'uid', 'timestamp').get(id=pid)
     except DoesNotExist:
         raise CRUDException("post does not exist")
 
-    if SnapShare.objects(uid=uid, post=post).first():
+    try:
+        snapshare = SnapShare(uid=uid, post=post).save() # unique (uid, post) index
+    except NotUniqueError:
         raise CRUDException("snapshare already exist")
 
-    snapshare = SnapShare(uid=uid, post=post).save()
-    user.snapshare.append(snapshare)
-    user.save()
-    post.snapshares += 1
-    post.save()
+    counters.add(pid, 'snapshares', 1)
+    counters.add_stats(uid, snapshare.timestamp, posts=1)
+    counters.add_stats(post.uid, post.timestamp, snapshares=1)
+    timeline.forget(uid)
 
     
-async def is_snapshared(uid: str, pid: str):
-    user = await get_user(uid)
-    try:
-        post = Post.objects.get(id=pid)
-        snapshare = SnapShare.objects.get(uid=uid, post=post)
-    except DoesNotExist:
-        return False
-    return True
+@offload
+def is_snapshared(uid: str, pid: str):
+    return relaxed(SnapShare.objects(uid=uid, post=pid)).only('id').first() is not None
 
   
-async def read_snapshares(uid: str, limit: int, page: int):
-    user = await get_user(uid)
-    FROM, TO = limit * page, limit * (page + 1)
+@offload
+def read_snapshares(uid: str, limit: int, page: int, cursor: Optional[str] = None, fields: List[str] = []):
+    queryset = relaxed(SnapShare.objects(uid=uid, is_blocked=False)) # served by the (uid, timestamp) index
+    only = [field for field in projection(fields) if field in SnapShare._fields]
+    if fields:
+        queryset = queryset.only(*only, 'timestamp', 'post') # shared posts are trimmed when rendered
+    db_snapshares = list(paginate(queryset, limit, page, cursor).as_pymongo())
+    cursor = next_cursor(db_snapshares, limit)
     snapshares = []
 
-    for db_snapshare in user.snapshare[FROM:TO]:
-        if db_snapshare.is_blocked or db_snapshare.post.is_blocked:
+    for snapshare in resolve_snapshares(db_snapshares):
+        if snapshare['post']['is_blocked']:
             continue
-        post = db_snapshare.post.to_mongo()
-        snapshare = db_snapshare.to_mongo()
-        snapshare['post'] = post
-        snapshares.append(snapshare.to_dict())
-    return snapshares
+        snapshares.append(snapshare)
+    return snapshares, cursor
 
 
-async def delete_snapshare(uid: str, pid: str):
+@offload
+def delete_snapshare(uid: str, pid: str):
     try:
-        post = Post.objects.get(id=pid)
-        snapshare = SnapShare.objects.get(uid=uid, post=post)
+        post = Post.objects.only('id', 'uid', 'timestamp').get(id=pid)
     except DoesNotExist:
         raise CRUDException("snapshare does not exist")
 
-    post.snapshares -= 1
-    post.save()
-    snapshare.delete()
+    snapshare = SnapShare.objects(uid=uid, post=post).modify(remove=True) # find and delete
+    if snapshare is None:
+        raise CRUDException("snapshare does not exist")
+    counters.add(pid, 'snapshares', -1)
+    counters.add_stats(uid, snapshare.timestamp, posts=-1)
+    counters.add_stats(post.uid, post.timestamp, snapshares=-1)
+    timeline.forget(uid)
 
     
-async def get_trending_topics(limit: int, page: int):
-    FROM, TO = limit * page, limit * (page + 1)
-    topics = TrendingTopic.objects()[FROM:TO].order_by('-mentions')
-    return [{"topic": topic.topic, "mention_count": len(topic.mentions)} for topic in topics]
-
- 
-async def get_trending_topic(topic: str):
-    try:
-        trending = TrendingTopic.objects.get(topic=topic)
-    except DoesNotExist:
-        print("[DEBUG] topic doesnt exists")
-        trending = TrendingTopic(topic=topic).save() # init one if does not exist
-    return trending 
-
-
-async def update_trending_topics(hashtags: List[str]):
-    for topic in hashtags:
-        mention = TopicMention()
-        mention.save()
-        trending_topic = await get_trending_topic(topic)
-        trending_topic.mentions.append(mention)
-        trending_topic.last_mentioned = datetime.utcnow
-        trending_topic.save()
-
-
-#Post.objects(timestamp__gte=start, timestamp__lte=end).sum("snapshares")
-#Post.objects(timestamp__gte=start, timestamp__lte=end).sum("likes")
-#Post.objects(timestamp__gte=start, timestamp__lte=end).count()
-async def get_stats(uid: str, start_date: datetime, end_date: datetime):
-
-    total_posts = BasePost.objects(uid=uid, timestamp__gte=start_date, timestamp__lte=end_date).count()
-    total_likes = Post.objects(uid=uid, timestamp__gte=start_date, timestamp__lte=end_date).sum('likes')
-    total_snapshares = Post.objects(uid=uid, timestamp__gte=start_date, timestamp__lte=end_date).sum('snapshares')
+def trending_page(topics: List[Dict[str, Any]], limit: int, page: int, cursor: Optional[str]):
+    start = limit * page
+    if cursor:
+        try:
+            offset, topic = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+            start = trending.position_after(topic, int(offset))
+        except ValueError:
+            raise CRUDException("invalid cursor")
+    page = topics[start:start + limit]
+    cursor = None
+    if page and start + limit < len(topics):
+        # next page starts right after the last topic, wherever it is ranked by then
+        cursor = base64.urlsafe_b64encode(f"{start + limit}:{page[-1]['topic']}".encode()).decode()
+    return page, cursor
+
+
+@offload
+def get_trending_topics(limit: int, page: int, cursor: Optional[str] = None,
+                        max_age: float = trending.REFRESH) -> Dict[str, Any]:
+    '''
+        rendered page of the current ranking: {'body', 'etag', 'cursor'}. each
+        page is rendered once per ranking refresh and served from cache.trendings
+    '''
+    epoch, topics = trending.ranking(max_age)
+
+    def render(key):
+        content, next_cursor = trending_page(topics, limit, page, cursor)
+        body = serialize.dumps(content)
+        return {'body': body, 'etag': serialize.etag(body), 'cursor': next_cursor}
+
+    return cache.trendings.get((epoch, limit, page, cursor), render)
+
+
+@offload
+def get_stats(uid: str, start_date: datetime, end_date: datetime):
+    # sum of the daily rollups, at most one row per day in the range
+    pipeline = [
+        {'$match': {'uid': uid, 'day': {'$gte': counters.day_of(start_date), '$lte': end_date}}},
+        {'$group': {
+            '_id': None,
+            'total_posts': {'$sum': '$posts'},
+            'total_likes': {'$sum': '$likes'},
+            'total_snapshares': {'$sum': '$snapshares'},
+        }},
+    ]
+    totals = next(relaxed(PostStats.objects).aggregate(pipeline), {})
     return {
-        'total_posts': total_posts,
-        'total_likes': total_likes,
-        'total_snapshares': total_snapshares,
+        'total_posts': totals.get('total_posts', 0),
+        'total_likes': totals.get('total_likes', 0),
+        'total_snapshares': totals.get('total_snapshares', 0),
     }
@@ -0,0 +1,202 @@
+from .database import offload, run
+from .models import BasePost, Post, Interaction, User, PostStats, UserDeletion
+from . import cache
+from . import counters
+from . import timeline
+from . import trending
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context
+from functools import partial
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+import asyncio
+import os
+import threading
+
+'''
+    background deletion of a user: their likes/favs, their snapshares, their
+    posts (with the snapshares and likes/favs of others on them), their stats
+    rollups and the user document.
+
+    everything is deleted in chunks of DELETE_USER_CHUNK documents read in
+    index order, each chunk with one delete_many per collection instead of
+    the per-document reverse delete rules of mongoengine. the counters and
+    rollups of the other users' posts touched are fixed with one bulk per
+    chunk, the trending buckets of the deleted posts as well.
+
+    progress is kept in a UserDeletion document per user. a job interrupted
+    by a shutdown is queued again and resumed on the next startup; one whose
+    worker died is resumed once it has not progressed for DELETE_USER_STALE
+    minutes. deleting again a user is a no-op while its job is running.
+
+    jobs run on their own DELETE_USER_WORKERS threads, at most that many at
+    once: a wave of deletions (or of resumed ones) never takes db workers
+    away from the requests.
+'''
+CHUNK = int(os.environ.get("DELETE_USER_CHUNK", 1000))
+STALE = timedelta(minutes=int(os.environ.get("DELETE_USER_STALE", 5)))
+WORKERS = int(os.environ.get("DELETE_USER_WORKERS", 2))
+EPOCH = datetime(1970, 1, 1)
+
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="posts-deletion")
+
+_stopping = threading.Event()
+_tasks = set() # running jobs, a reference is needed until they finish
+
+
+class Interrupted(Exception):
+    pass
+
+
+def claim(uid: str) -> Optional[Dict[str, Any]]:
+    '''
+        queue the deletion of `uid`, None if it is already queued or running.
+        atomic: the upsert can only match a finished or stale job, otherwise
+        it hits the unique uid index
+    '''
+    now = datetime.utcnow()
+    try:
+        return UserDeletion._get_collection().find_one_and_update(
+            {'uid': uid, '$or': [{'status': {'$in': ['done', 'failed']}}, {'updated': {'$lt': now - STALE}}]},
+            {'$set': {
+                'status': 'queued', 'posts': 0, 'snapshares': 0, 'interactions': 0,
+                'error': None, 'created': now, 'updated': now,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        return None
+
+
+def progress(uid: str, **deleted: int):
+    # counts of a chunk already deleted, then stop there on shutdown
+    UserDeletion._get_collection().update_one(
+        {'uid': uid},
+        {'$inc': deleted, '$set': {'updated': datetime.utcnow()}},
+    )
+    if _stopping.is_set():
+        raise Interrupted()
+
+
+def finish(uid: str, status: str, error: str = None, updated: datetime = None):
+    UserDeletion._get_collection().update_one(
+        {'uid': uid},
+        {'$set': {'status': status, 'error': error, 'updated': updated or datetime.utcnow()}},
+    )
+
+
+def authors_of(ids: List) -> List[Dict[str, Any]]:
+    return list(Post.objects(id__in=ids).only('uid', 'timestamp').as_pymongo())
+
+
+def delete_interactions(uid: str):
+    # likes/favs given by the user, taken out of the liked posts counters and their authors rollups
+    edges = Interaction._get_collection()
+    while True:
+        chunk = list(edges.find({'uid': uid}, {'post': 1, 'kind': 1}).limit(CHUNK)) # (uid, post, kind) index
+        if not chunk:
+            return
+        edges.delete_many({'_id': {'$in': [edge['_id'] for edge in chunk]}})
+        liked = [edge['post'] for edge in chunk if edge['kind'] == 'like']
+        if liked:
+            counters.add_many((pid, {'likes': -1}) for pid in liked)
+            counters.add_stats_many((post['uid'], post['timestamp'], {'likes': -1}) for post in authors_of(liked))
+        progress(uid, interactions=len(chunk))
+
+
+def delete_snapshares(uid: str):
+    # snapshares made by the user, taken out of the shared posts counters and their authors rollups
+    posts = BasePost._get_collection()
+    while True:
+        query = {'uid': uid, 'post': {'$exists': True}} # partial (uid, post) index
+        chunk = list(posts.find(query, {'post': 1}).limit(CHUNK))
+        if not chunk:
+            return
+        posts.delete_many({'_id': {'$in': [snapshare['_id'] for snapshare in chunk]}})
+        shared = [snapshare['post'] for snapshare in chunk]
+        counters.add_many((pid, {'snapshares': -1}) for pid in shared)
+        counters.add_stats_many((post['uid'], post['timestamp'], {'snapshares': -1}) for post in authors_of(shared))
+        timeline.forget(uid)
+        progress(uid, snapshares=len(chunk))
+
+
+def delete_posts(uid: str):
+    # the user posts, newest first over the (uid, timestamp, _id) index, with what references them
+    posts = BasePost._get_collection()
+    edges = Interaction._get_collection()
+    while True:
+        chunk = list(posts.find({'uid': uid}, {'hashtags': 1, 'timestamp': 1}) \
+            .sort([('timestamp', -1), ('_id', -1)]).limit(CHUNK))
+        if not chunk:
+            return
+        ids = [post['_id'] for post in chunk]
+
+        # snapshares of these posts by others, taken out of the sharers rollups
+        shares = list(posts.find({'post': {'$in': ids}}, {'uid': 1, 'timestamp': 1}))
+        if shares:
+            posts.delete_many({'_id': {'$in': [snapshare['_id'] for snapshare in shares]}})
+            counters.add_stats_many((snapshare['uid'], snapshare['timestamp'], {'posts': -1}) for snapshare in shares)
+        interactions = edges.delete_many({'post': {'$in': ids}}).deleted_count
+
+        posts.delete_many({'_id': {'$in': ids}})
+        cache.posts.invalidate(*ids)
+        timeline.forget(uid, *{snapshare['uid'] for snapshare in shares})
+        trending.remove_mentions(
+            (hashtag, post['timestamp']) for post in chunk for hashtag in post.get('hashtags', [])
+        )
+        progress(uid, posts=len(chunk), snapshares=len(shares), interactions=interactions)
+
+
+def delete_user(uid: str):
+    finish(uid, 'running')
+    try:
+        delete_interactions(uid)
+        delete_snapshares(uid)
+        delete_posts(uid)
+        PostStats._get_collection().delete_many({'uid': uid})
+        User._get_collection().delete_many({'uid': uid})
+    except Interrupted:
+        finish(uid, 'queued', updated=EPOCH) # stale right away, resumed on the next startup
+        return
+    except Exception as exc:
+        print(f"[ERROR] deletion of user {uid} failed: {exc}")
+        finish(uid, 'failed', error=str(exc))
+        return
+    finish(uid, 'done')
+
+
+def schedule(uid: str):
+    # empty context: the job outlives the request that scheduled it, its commands
+    # must not be added to that request's stats (instrument.current) but sent as route:background
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(loop.run_in_executor(executor, partial(Context().run, run, delete_user, uid)))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def pending() -> List[str]:
+    # queued or running jobs nobody is working on
+    stale = UserDeletion.objects(status__in=('queued', 'running'), updated__lt=datetime.utcnow() - STALE)
+    return [job['uid'] for job in stale.only('uid').as_pymongo()]
+
+
+async def resume():
+    # called on startup
+    for uid in await offload(pending)():
+        if await offload(claim)(uid):
+            schedule(uid)
+
+
+def start():
+    # on startup: a previous shutdown in this process stopped the jobs
+    _stopping.clear()
+
+
+async def stop():
+    # called on shutdown: running jobs stop after their current chunk
+    _stopping.set()
+    if _tasks:
+        await asyncio.gather(*_tasks)
@@ -0,0 +1,202 @@
+from . import database
+from .metrics import statsd
+from collections import defaultdict
+from contextvars import ContextVar
+from pymongo import monitoring
+from typing import Any, Dict, List, Optional
+import asyncio
+import mongoengine
+import os
+import random
+import threading
+import time
+
+'''
+    hot path instrumentation
+
+    the Instrumentation middleware tags every request with its route template
+    and sends to statsd:
+        posts.request.latency          ms
+        posts.request.mongo_roundtrips commands sent to mongo
+        posts.request.response_bytes   body size
+    and, per (function, command, collection) the request used, where function
+    is the offloaded crud function that sent the commands:
+        posts.mongo.roundtrips, posts.mongo.latency (ms), posts.mongo.docs_returned
+    commands sent outside a request (write-behind pipeline, counters flush,
+    deletion jobs...) are sent as they complete with route:background.
+
+    the slow request sampler is off by default. with POSTS_EXPLAIN_SLOW_MS set,
+    POSTS_EXPLAIN_RATE of the requests slower than that get their reads
+    re-run with explain in the background: the plan (e.g. LIMIT>FETCH>IXSCAN,
+    COLLSCAN) is logged and docs/keys examined are sent as
+    posts.mongo.docs_examined and posts.mongo.keys_examined.
+'''
+EXPLAIN_SLOW_MS = float(os.environ.get("POSTS_EXPLAIN_SLOW_MS", 0)) # 0: sampler off
+EXPLAIN_RATE = float(os.environ.get("POSTS_EXPLAIN_RATE", 0.1))
+EXPLAIN_MAX = 20 # reads kept per request
+EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct'}
+SESSION_FIELDS = {'lsid', 'txnNumber', '$db', '$clusterTime', '$readPreference', 'readConcern'}
+
+
+class RequestStats:
+    # shared by the request task and the db threads it offloads to
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = defaultdict(lambda: [0, 0.0, 0]) # (function, command, collection) -> [n, ms, docs]
+        self.reads: List[tuple] = [] # (database, command) for the sampler
+        self.response_bytes = 0
+
+    def add(self, key: tuple, ms: float, docs: int):
+        with self.lock:
+            totals = self.commands[key]
+            totals[0] += 1
+            totals[1] += ms
+            totals[2] += docs
+
+
+current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def returned(reply: Dict[str, Any]) -> int:
+    # documents in a find/getMore/aggregate batch, `n` affected for writes
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    return reply.get('n', 0)
+
+
+def emit(key: tuple, totals: list, tags: List[str]):
+    function, command, collection = key
+    tags = tags + [f"function:{function}", f"command:{command}", f"collection:{collection}"]
+    n, ms, docs = totals
+    statsd.histogram("posts.mongo.roundtrips", n, tags=tags)
+    statsd.histogram("posts.mongo.latency", ms, tags=tags)
+    statsd.histogram("posts.mongo.docs_returned", docs, tags=tags)
+
+
+class MongoListener(monitoring.CommandListener):
+    def __init__(self):
+        self._collections: Dict[int, str] = {} # request_id -> collection of the commands in flight
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[event.request_id] = collection if isinstance(collection, str) else "-"
+        stats = current.get()
+        if stats is not None and EXPLAIN_SLOW_MS and event.command_name in EXPLAINABLE \
+                and len(stats.reads) < EXPLAIN_MAX:
+            command = {field: value for field, value in event.command.items() if field not in SESSION_FIELDS}
+            stats.reads.append((event.database_name, command))
+
+    def succeeded(self, event):
+        # no reply size: re-encoding every reply costs more than rendering the page
+        self.record(event, returned(event.reply))
+
+    def failed(self, event):
+        self.record(event, 0)
+
+    def record(self, event, docs: int):
+        key = (
+            database.function.get() or "-",
+            event.command_name,
+            self._collections.pop(event.request_id, "-"),
+        )
+        ms = event.duration_micros / 1000
+        stats = current.get()
+        if stats is None:
+            emit(key, [1, ms, docs], ["route:background"])
+        else:
+            stats.add(key, ms, docs)
+
+
+listener = MongoListener()
+monitoring.register(listener) # for every client created from now on
+
+
+def plan_of(explained: Dict[str, Any]) -> str:
+    # stages of the winning plan, outermost first
+    def find(doc, key):
+        if isinstance(doc, dict):
+            if key in doc:
+                return doc[key]
+            children = doc.values()
+        elif isinstance(doc, list):
+            children = doc
+        else:
+            return None
+        for child in children:
+            found = find(child, key)
+            if found is not None:
+                return found
+        return None
+
+    stages, plan = [], find(explained, 'winningPlan') or {}
+    plan = plan.get('queryPlan', plan)
+    while plan:
+        stages.append(plan.get('stage', '?'))
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ">".join(stages) or "?"
+
+
+def explain(route: str, ms: float, reads: List[tuple]):
+    client = mongoengine.get_connection()
+    for db, command in reads:
+        try:
+            explained = client[db].command({'explain': command, 'verbosity': 'executionStats'})
+        except Exception as exc:
+            print(f"[WARN] explain failed for {route}: {exc}")
+            continue
+        stats = explained.get('executionStats') or {}
+        name = next(iter(command))
+        plan = plan_of(explained)
+        tags = [f"route:{route}", f"command:{name}", f"collection:{command[name]}", f"plan:{plan}"]
+        statsd.histogram("posts.mongo.docs_examined", stats.get('totalDocsExamined', 0), tags=tags)
+        statsd.histogram("posts.mongo.keys_examined", stats.get('totalKeysExamined', 0), tags=tags)
+        print(f"[SLOW] {route} {ms:.0f}ms {name} {command[name]} plan={plan} "
+              f"keys={stats.get('totalKeysExamined')} docs={stats.get('totalDocsExamined')} "
+              f"returned={stats.get('nReturned')} filter={command.get('filter', command.get('pipeline'))}")
+
+
+class Instrumentation:
+    # pure ASGI middleware, also sees streamed responses
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current.set(stats)
+        status = "error" # unhandled exceptions are answered by the outer error handler
+        start = time.perf_counter()
+
+        async def send_counted(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                stats.response_bytes += len(message.get('body', b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            current.reset(token)
+            ms = (time.perf_counter() - start) * 1000
+            route = scope.get('route')
+            route = f"{scope['method']} {route.path if route else 'unmatched'}"
+            self.report(route, status, ms, stats)
+
+    def report(self, route: str, status, ms: float, stats: RequestStats):
+        tags = [f"route:{route}"]
+        with stats.lock:
+            commands = dict(stats.commands)
+        statsd.histogram("posts.request.latency", ms, tags=tags + [f"status:{status}"])
+        statsd.histogram("posts.request.mongo_roundtrips", sum(totals[0] for totals in commands.values()), tags=tags)
+        statsd.histogram("posts.request.response_bytes", stats.response_bytes, tags=tags)
+        for key, totals in commands.items():
+            emit(key, totals, tags)
+
+        if EXPLAIN_SLOW_MS and ms >= EXPLAIN_SLOW_MS and stats.reads and random.random() < EXPLAIN_RATE:
+            # off the request path, on the db executor
+            asyncio.get_running_loop().run_in_executor(database.executor, explain, route, ms, stats.reads)
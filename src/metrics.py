@@ -0,0 +1,14 @@
+from datadog import initialize, DogStatsd
+
+options = {
+    'statsd_host': 'datadog-agent',
+    'statsd_port': 8125,
+}
+# buffered: metrics are sent in batches by a flush thread (every 0.3s), not one
+# udp packet per call from the request path (cache hits, per request histograms)
+statsd = DogStatsd(disable_buffering=False)
+
+
+def init():
+    # on startup, see main.lifespan
+    initialize(**options)
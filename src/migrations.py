@@ -0,0 +1,123 @@
+from . import database
+from .models import User, Interaction, BasePost, Post, SnapShare, PostStats
+from pymongo import UpdateOne
+from datetime import datetime, timedelta
+
+'''
+    one-off data migrations, run with `python -m src.migrations`
+'''
+LEGACY_USER_FIELDS = ('public', 'private', 'favs', 'liked', 'snapshare')
+
+
+def migrate_user_interactions(batch_size: int = 100):
+    '''
+        move the `liked`/`favs` lists of the old User documents to Interaction
+        edges and drop every reference list from them. public/private/snapshare
+        are not copied, posts and snapshares already hold their author uid.
+
+        edges get decreasing timestamps following the list order, so the
+        newest fav stays first. safe to re-run: edges are upserted and only
+        users still holding a list are visited
+    '''
+    users = User._get_collection()
+    interactions = Interaction._get_collection()
+    legacy = {'$or': [{field: {'$exists': True}} for field in LEGACY_USER_FIELDS]}
+    migrated = 0
+
+    for user in users.find(legacy, batch_size=batch_size):
+        now = datetime.utcnow()
+        ops = []
+        for field, kind in (('liked', 'like'), ('favs', 'fav')):
+            refs = user.get(field, [])
+            for i, pid in enumerate(refs):
+                timestamp = now - timedelta(milliseconds=len(refs) - i)
+                ops.append(UpdateOne(
+                    {'uid': user['uid'], 'post': pid, 'kind': kind},
+                    {'$setOnInsert': {'timestamp': timestamp}},
+                    upsert=True,
+                ))
+        if ops:
+            interactions.bulk_write(ops, ordered=False)
+        users.update_one({'_id': user['_id']}, {'$unset': {field: "" for field in LEGACY_USER_FIELDS}})
+        migrated += 1
+    return migrated
+
+
+def dedupe_snapshares(batch_size: int = 1000):
+    '''
+        delete the repeated snapshares of a post by the same user, left from
+        before the unique (uid, post) index existed; the index can't be built
+        while they are there. the oldest one is kept and the `snapshares`
+        counter of the posts involved is recounted. rollups are rebuilt by
+        backfill_post_stats. safe to re-run
+    '''
+    posts = BasePost._get_collection()
+    pipeline = [
+        {'$match': {'post': {'$exists': True}}},
+        {'$sort': {'timestamp': 1, '_id': 1}},
+        {'$group': {'_id': {'uid': '$uid', 'post': '$post'}, 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}},
+    ]
+    extra, shared = [], set()
+    for group in posts.aggregate(pipeline, allowDiskUse=True):
+        extra += group['ids'][1:]
+        shared.add(group['_id']['post'])
+    for i in range(0, len(extra), batch_size):
+        posts.delete_many({'_id': {'$in': extra[i:i + batch_size]}})
+
+    ops = [
+        UpdateOne({'_id': pid}, {'$set': {'snapshares': posts.count_documents({'post': pid})}})
+        for pid in shared
+    ]
+    for i in range(0, len(ops), batch_size):
+        Post._get_collection().bulk_write(ops[i:i + batch_size], ordered=False)
+    return len(extra)
+
+
+def backfill_post_stats(batch_size: int = 1000):
+    '''
+        (re)build every PostStats rollup from the posts with one $group per
+        (author, day). rollups are overwritten, not incremented, so it can be
+        re-run; run it while writes are paused to not lose concurrent deltas
+    '''
+    pipeline = [
+        {'$group': {
+            '_id': {
+                'uid': '$uid',
+                'day': {'$dateFromParts': {
+                    'year': {'$year': '$timestamp'},
+                    'month': {'$month': '$timestamp'},
+                    'day': {'$dayOfMonth': '$timestamp'},
+                }},
+            },
+            'posts': {'$sum': 1},
+            'likes': {'$sum': {'$ifNull': ['$likes', 0]}}, # snapshares have no counters
+            'snapshares': {'$sum': {'$ifNull': ['$snapshares', 0]}},
+        }},
+    ]
+    stats = PostStats._get_collection()
+    ops, rows = [], 0
+    for row in BasePost._get_collection().aggregate(pipeline, allowDiskUse=True):
+        ops.append(UpdateOne(
+            row['_id'],
+            {'$set': {'posts': row['posts'], 'likes': row['likes'], 'snapshares': row['snapshares']}},
+            upsert=True,
+        ))
+        if len(ops) == batch_size:
+            stats.bulk_write(ops, ordered=False)
+            rows += len(ops)
+            ops = []
+    if ops:
+        stats.bulk_write(ops, ordered=False)
+        rows += len(ops)
+    return rows
+
+
+if __name__ == "__main__":
+    database.connect()
+    print(f"[INFO] deleted {dedupe_snapshares()} repeated snapshares")
+    SnapShare.ensure_indexes()
+    Interaction.ensure_indexes()
+    PostStats.ensure_indexes()
+    print(f"[INFO] migrated {migrate_user_interactions()} users")
+    print(f"[INFO] rebuilt {backfill_post_stats()} post stats rollups")
@@ -9,12 +9,12 @@ from mongoengine import (
     EmbeddedDocument,
     EmbeddedDocumentField,
     CASCADE, 
-    PULL 
 )
 from fastapi import Query, Depends
 from typing_extensions import Annotated
 from pydantic import BaseModel, Field, BeforeValidator, AfterValidator, model_validator
 from datetime import datetime
+from pymongo.errors import OperationFailure
 from typing import List, Dict, Any, Optional, Generic, TypeVar
 from collections.abc import Iterable
 
@@ -31,7 +31,11 @@ class BasePost(Document):
     meta = {
         'indexes': [
             {
-                'fields': [('uid', 1), ('timestamp', -1)],  # compound index 
+                # compound index, visibility flags last so pid/uid/timestamp pages are covered
+                'fields': ['uid', '-timestamp', '-id', 'is_private', 'is_blocked'], 'cls': False,
+            },
+            {
+                'fields': ['-timestamp', '-id'], 'cls': False,  # unfiltered feeds
             }
         ],
         'allow_inheritance': True,
@@ -45,50 +49,132 @@ class Post(BasePost):
     likes: int = IntField(default=0, min_value=0)
     snapshares: int = IntField(default=0, min_value=0)
 
+    meta = {
+        'indexes': [
+            {
+                'fields': ['hashtags', '-timestamp', '-id'], 'cls': False,  # multikey
+            },
+            {
+                'fields': ['$text', '$hashtags'], 'cls': False,  # full-text search
+                'default_language': 'none', 'weights': {'text': 1, 'hashtags': 2},
+            }
+        ],
+    }
+
         
 class SnapShare(BasePost):
     post = ReferenceField(Post, reverse_delete_rule=CASCADE) # delete document when referenced is deleted
-    
-
-# `ReferenceField` will be automatically dereferenced on access (consider efficency)
-# https://docs.mongoengine.org/apireference.html#mongoengine.fields.ReferenceField
-PostReference = ReferenceField(Post, reverse_delete_rule=PULL)
-SnapShareReference = ReferenceField(SnapShare, reverse_delete_rule=PULL)
 
+    meta = {
+        'indexes': [
+            {
+                'fields': ['post'], 'sparse': True, # snapshares of a post
+            },
+            {
+                # a user can snapshare a post only once (posts have no `post` field).
+                # last: it fails on legacy duplicates (make migrate) and stops the ones after it
+                'fields': ['uid', 'post'], 'cls': False, 'unique': True,
+                'partialFilterExpression': {'post': {'$exists': True}},
+            },
+        ],
+    }
+    
 
 class User(Document):
+    # the old reference lists (public, private, favs, liked, snapshare) are
+    # moved out by migrations.migrate_user_interactions
     uid: str = StringField(required=True, unique=True)
-    public = ListField(PostReference, default=[]) 
-    private = ListField(PostReference, default=[]) 
-    favs = ListField(PostReference, default=[]) 
-    liked = ListField(PostReference, default=[])
-    snapshare = ListField(SnapShareReference, default=[])
+
+    meta = {
+        'strict': False, # not yet migrated documents still have the lists
+    }
 
 
-class TopicMention(Document):
+class Interaction(Document):
+    # user -> post edge, one document per like/fav
+    uid: str = StringField(required=True)
+    post = ReferenceField(Post, required=True, reverse_delete_rule=CASCADE) # removed with the post
+    kind: str = StringField(required=True, choices=('like', 'fav'))
     timestamp = DateTimeField(default=datetime.utcnow)
+
     meta = {
         'indexes': [
             {
-                'fields': ['timestamp'], 'expireAfterSeconds': (60 * 60 * 24) # ttl index
+                'fields': ['uid', 'post', 'kind'], 'unique': True, # membership checks
+            },
+            {
+                'fields': ['uid', 'kind', '-timestamp', '-id'], # listing
+            },
+            {
+                'fields': ['post'], # cascade when the post is deleted
             }
         ]
     }
 
-TopicMentionReference = ReferenceField(TopicMention, reverse_delete_rule=PULL)
 
-class TrendingTopic(Document):
-    topic = StringField(required=True, unique=True)
-    mentions = ListField(TopicMentionReference, default=[])
-    last_mentioned = DateTimeField(default=datetime.utcnow)
-    
+class PostStats(Document):
+    # daily rollup of the posts created by `uid` on `day`, see counters.py
+    uid: str = StringField(required=True)
+    day = DateTimeField(required=True) # midnight utc
+    posts: int = IntField(default=0)
+    likes: int = IntField(default=0)
+    snapshares: int = IntField(default=0)
+
     meta = {
         'indexes': [
             {
-                'fields': ['last_mentioned'], 'expireAfterSeconds': (60 * 60 * 24) # ttl index
+                'fields': ['uid', 'day'], 'unique': True,
             }
         ]
     }
+
+
+class UserDeletion(Document):
+    # background deletion of everything of a user, see deletion.py
+    uid: str = StringField(required=True, unique=True)
+    status: str = StringField(default='queued', choices=('queued', 'running', 'done', 'failed'))
+    posts: int = IntField(default=0) # deleted so far
+    snapshares: int = IntField(default=0)
+    interactions: int = IntField(default=0)
+    error: str = StringField()
+    created = DateTimeField(default=datetime.utcnow)
+    updated = DateTimeField(default=datetime.utcnow) # last progress, older than deletion.STALE means stuck
+
+
+class TopicBucket(Document):
+    # mentions of a topic during one minute, see trending.py
+    topic = StringField(required=True)
+    bucket = DateTimeField(required=True)
+    count = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': [('topic', 1), ('bucket', 1)], 'unique': True,
+            },
+            {
+                'fields': ['bucket'], 'expireAfterSeconds': (60 * 60 * 24) # ttl index
+            }
+        ]
+    }
+
+
+# every collection of the service. their indexes are created once on startup
+# (see main.warm_up), not by mongoengine on first use in every process
+DOCUMENTS = (BasePost, Post, SnapShare, User, Interaction, PostStats, UserDeletion, TopicBucket)
+for document in DOCUMENTS:
+    document._meta['auto_create_index'] = False
+
+
+def ensure_indexes():
+    for document in DOCUMENTS:
+        try:
+            document.ensure_indexes()
+        except OperationFailure as exc:
+            # a unique index over duplicated data won't build however often it is retried
+            if exc.code not in (11000, 11001):
+                raise
+            print(f"[ERROR] {document.__name__} indexes not built, run make migrate: {exc}")
     
 
 '''
@@ -98,7 +184,6 @@ class BaseModelOptional(BaseModel): # BaseModel wrapper
     @model_validator(mode="after")
     def exclude_unset(cls, values: Any) -> Any:
         # remove unset attributes
-        print(values)
         items = values.dict().items()
         for k, v in items:
             if v is None or (isinstance(v, Iterable) and not v):
@@ -106,7 +191,6 @@ class BaseModelOptional(BaseModel): # BaseModel wrapper
         return values   
 
 def pid_validator(pid):
-    print(f"PID VALIDATOR: {str(pid)}")
     return str(pid)
 
 def text_validator(t):
@@ -144,6 +228,21 @@ class PostQuery(BaseModelOptional):
     hashtags: List[Hashtag] = Field(Query([]))
     blocked: bool = False
     private: bool = False
+
+
+class PostModeration(BaseModel):
+    # posts matching all the given criteria are blocked/unblocked, at least one is required
+    is_blocked: bool
+    uid: Optional[str] = None # author's uid
+    hashtags: List[Hashtag] = [] # any of them
+    since: Optional[datetime] = None # timestamp >= since
+    until: Optional[datetime] = None # timestamp < until
+    pids: List[str] = Field([], max_length=100000)
+
+
+class PostModerationResponse(BaseModel):
+    posts: int # posts changed
+    snapshares: int # snapshares of them changed
    
 class PostResponse(PostCreate):
     pid: PID = Field(validation_alias="_id")
@@ -168,7 +267,34 @@ class SnapShareResponse(BaseModel):
         allow_population_by_field_name = True
 
 
+class PostFlags(BaseModel):
+    # relation of one user with one post
+    liked: bool = False
+    faved: bool = False
+    snapshared: bool = False
+    author: bool = False
+
+
+class PostViewResponse(PostResponse):
+    flags: PostFlags
+
+
+class SnapShareViewResponse(SnapShareResponse):
+    flags: PostFlags # flags of the snapshared post
+
+
 class PostStatsResponse(BaseModel):
     total_posts: int
     total_likes: int
-    total_snapshares: int
\ No newline at end of file
+    total_snapshares: int
+
+
+class UserDeletionResponse(BaseModel):
+    uid: str
+    status: str
+    posts: int = 0
+    snapshares: int = 0
+    interactions: int = 0
+    error: Optional[str] = None
+    created: datetime
+    updated: datetime
@@ -0,0 +1,82 @@
+from .database import offload
+from .metrics import statsd
+from . import trending
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+import asyncio
+import os
+
+'''
+    write-behind pipeline for the side effects of creating posts
+
+    POST /posts only waits for the post itself to be written; its trending
+    mentions and statsd metrics are queued here and applied in batches by a
+    background task. a batch takes up to PIPELINE_BATCH queued posts and
+    coalesces them, so 500 posts tagged #foo become a single $inc of 500 on
+    its trending bucket and a single statsd increment.
+
+    the queue is bounded by PIPELINE_QUEUE_SIZE: when it is full, requests
+    wait on submit() (backpressure) instead of piling up memory. on shutdown
+    drain() flushes what is still queued.
+'''
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 10000))
+BATCH_SIZE = int(os.environ.get("PIPELINE_BATCH", 500))
+FLUSH_INTERVAL = float(os.environ.get("PIPELINE_FLUSH", 0.5)) # seconds between batches
+
+STOP = None # queued by drain(), ends run() once everything before it is flushed
+
+_queue: Optional[asyncio.Queue] = None
+_draining = False
+
+
+async def flush(batch: List[Tuple[int, List[str]]]):
+    posted = sum(n for n, _ in batch)
+    counts = Counter(hashtag for _, hashtags in batch for hashtag in hashtags)
+    try:
+        await offload(trending.record_mentions)(counts)
+    except Exception as exc:
+        # trending is best effort, a failed batch must not stop the pipeline
+        print(f"[ERROR] trending update of {len(counts)} topics failed: {exc}")
+
+    statsd.increment(metric="snapmsg.posted", value=posted)
+    for hashtag, n in counts.items():
+        statsd.increment(metric="hashtags.used", value=n, tags=[f'hashtag:{hashtag[1:]}'])
+
+
+async def submit(hashtags: Iterable[str], posts: int = 1):
+    # queue the side effects of `posts` new posts, waits while the queue is full
+    item = (posts, list(hashtags))
+    if _queue is None:
+        await flush([item]) # pipeline not running (scripts, tests): apply right away
+        return
+    await _queue.put(item)
+
+
+async def run():
+    stopping = False
+    while not stopping:
+        batch = [await _queue.get()]
+        while len(batch) < BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
+        if STOP in batch:
+            stopping = True
+            batch.remove(STOP)
+        if batch:
+            await flush(batch)
+        if not stopping and not _draining:
+            await asyncio.sleep(FLUSH_INTERVAL) # let the next batch build up
+
+
+def start() -> asyncio.Task:
+    # called on app startup, the queue must be created inside the running loop
+    global _queue
+    _queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    return asyncio.create_task(run())
+
+
+async def drain(task: asyncio.Task):
+    global _queue, _draining
+    _draining = True
+    await _queue.put(STOP)
+    await task
+    _queue = None # late submits are applied right away
@@ -0,0 +1,161 @@
+from . import cache
+from . import trending
+from .database import relaxed
+from .models import Post, SnapShare, Interaction
+from mongoengine.queryset.visitor import Q
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Dict, Any
+import numpy as np
+import os
+import time
+
+'''
+    feed recommendations
+
+    candidates are recent public posts that share a hashtag with what the
+    user liked, faved or snapshared, come from the authors they interact
+    with, or are on a trending topic. at most POOL_SIZE of them are kept per
+    user and ranked in one vectorized pass. the pool is topped up with only
+    the posts newer than its last fetch every RECOMMEND_REFRESH seconds and
+    rebuilt from scratch when it expires, so serving a page never scans the
+    posts collection. the profile is rebuilt with the pool every
+    RECOMMEND_POOL_TTL seconds.
+'''
+WINDOW = timedelta(days=int(os.environ.get("RECOMMEND_WINDOW_DAYS", 7)))
+POOL_SIZE = int(os.environ.get("RECOMMEND_POOL_SIZE", 500))
+REFRESH = float(os.environ.get("RECOMMEND_REFRESH", 30)) # seconds
+HISTORY = 200 # latest interactions used to build the user profile
+TOP_TAGS = 50
+TOP_AUTHORS = 50
+TRENDING = 20
+HALF_LIFE_HOURS = 24.0
+
+# score = WEIGHTS . (recency, popularity, hashtag overlap, author affinity, trending)
+WEIGHTS = np.array([1.0, 0.5, 1.5, 1.0, 0.5])
+
+pools = cache.LRUCache(
+    "recommended",
+    maxsize=int(os.environ.get("RECOMMEND_POOLS", 10000)),
+    ttl=float(os.environ.get("RECOMMEND_POOL_TTL", 600)),
+)
+
+
+def build_profile(uid: str) -> Dict[str, Any]:
+    # hashtags and authors of the posts the user recently interacted with
+    edges = relaxed(Interaction.objects(uid=uid, kind__in=('like', 'fav'))).only('post') \
+        .order_by('-timestamp', '-id').limit(HISTORY).as_pymongo()
+    shared = relaxed(SnapShare.objects(uid=uid)).only('post').order_by('-timestamp', '-id').limit(HISTORY).as_pymongo()
+    seen = {edge['post'] for edge in edges} | {snapshare['post'] for snapshare in shared}
+
+    tags, authors = Counter(), Counter()
+    if seen:
+        for post in relaxed(Post.objects(id__in=list(seen))).only('uid', 'hashtags').as_pymongo():
+            tags.update(post.get('hashtags', []))
+            authors[post['uid']] += 1
+    return {'tags': tags, 'authors': authors, 'seen': seen}
+
+
+def fetch_candidates(uid: str, profile: Dict[str, Any], topics: set, since: datetime) -> List[Dict[str, Any]]:
+    '''
+        newest matching posts after `since`. each $or branch is served by the
+        (hashtags, timestamp) or (uid, timestamp) index; users without any
+        history get the latest posts from the (timestamp, _id) index
+    '''
+    tags = [tag for tag, _ in profile['tags'].most_common(TOP_TAGS)] + list(topics)
+    authors = [author for author, _ in profile['authors'].most_common(TOP_AUTHORS) if author != uid]
+
+    query = Q(timestamp__gt=since, is_private=False, is_blocked=False, uid__ne=uid)
+    match = Q()
+    if tags:
+        match |= Q(hashtags__in=tags)
+    if authors:
+        match |= Q(uid__in=authors)
+    return list(relaxed(Post.objects(query & match)).order_by('-timestamp', '-id').limit(POOL_SIZE).as_pymongo())
+
+
+def unit(values: np.ndarray) -> np.ndarray:
+    top = values.max()
+    return values / top if top > 0 else values
+
+
+def rank(posts: List[Dict[str, Any]], profile: Dict[str, Any], topics: set, now: datetime) -> List[Dict[str, Any]]:
+    posts = [post for post in posts if post['_id'] not in profile['seen']]
+    if not posts:
+        return []
+    n = len(posts)
+    tag_weight = {tag: count / max(profile['tags'].values()) for tag, count in profile['tags'].items()}
+    author_weight = {author: count / max(profile['authors'].values()) for author, count in profile['authors'].items()}
+
+    age = np.fromiter(((now - post['timestamp']).total_seconds() / 3600 for post in posts), float, n)
+    likes = np.fromiter((post.get('likes', 0) for post in posts), float, n)
+    snapshares = np.fromiter((post.get('snapshares', 0) for post in posts), float, n)
+    overlap = np.fromiter((sum(tag_weight.get(tag, 0) for tag in post.get('hashtags', [])) for post in posts), float, n)
+    affinity = np.fromiter((author_weight.get(post['uid'], 0) for post in posts), float, n)
+    trend = np.fromiter((any(tag in topics for tag in post.get('hashtags', [])) for post in posts), float, n)
+
+    features = np.column_stack([
+        np.exp2(-age / HALF_LIFE_HOURS),
+        unit(np.log1p(likes + 2 * snapshares)),
+        unit(overlap),
+        affinity,
+        trend,
+    ])
+    order = np.argsort(-(features @ WEIGHTS), kind='stable')
+    return [posts[i] for i in order[:POOL_SIZE]]
+
+
+def current_topics() -> set:
+    return {row['topic'] for row in trending.top_topics()[:TRENDING]}
+
+
+def build_pool(uid: str) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    profile = build_profile(uid)
+    topics = current_topics()
+    candidates = fetch_candidates(uid, profile, topics, now - WINDOW)
+    return {
+        'profile': profile,
+        'ranked': rank(candidates, profile, topics, now),
+        'newest': max((post['timestamp'] for post in candidates), default=now - WINDOW),
+        'built_at': time.monotonic(),
+        'refreshed_at': time.monotonic(),
+    }
+
+
+def refresh_pool(uid: str, pool: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+        incremental refresh: fetch only the posts newer than the pool, reload
+        the counters of the ones already in it with a single $in, drop those
+        gone private/blocked/deleted or out of the window, and rerank
+    '''
+    now = datetime.utcnow()
+    profile = pool['profile']
+    topics = current_topics()
+    fresh = fetch_candidates(uid, profile, topics, pool['newest'])
+
+    posts = {post['_id']: post for post in pool['ranked'] if post['timestamp'] > now - WINDOW}
+    if posts:
+        current = Post.objects(id__in=list(posts)).only('likes', 'snapshares', 'is_private', 'is_blocked').as_pymongo()
+        live = {post['_id']: post for post in current if not post['is_private'] and not post['is_blocked']}
+        posts = {pid: {**post, **live[pid]} for pid, post in posts.items() if pid in live}
+    posts.update((post['_id'], post) for post in fresh)
+
+    return {
+        'profile': profile,
+        'ranked': rank(list(posts.values()), profile, topics, now),
+        'newest': max([pool['newest']] + [post['timestamp'] for post in fresh]),
+        'built_at': pool['built_at'],
+        'refreshed_at': time.monotonic(),
+    }
+
+
+def recommended(uid: str, limit: int, page: int) -> List[Dict[str, Any]]:
+    pool = pools.get(uid, build_pool)
+    if time.monotonic() - pool['built_at'] > pools.ttl:
+        pool = build_pool(uid) # profile is rebuilt too
+        pools.put(uid, pool)
+    elif time.monotonic() - pool['refreshed_at'] > REFRESH:
+        pool = refresh_pool(uid, pool)
+        pools.put(uid, pool)
+    return pool['ranked'][limit * page:limit * (page + 1)]
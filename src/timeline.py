@@ -0,0 +1,100 @@
+from . import cache
+from .database import relaxed_collection
+from .models import BasePost
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from bson import ObjectId
+import heapq
+import os
+
+'''
+    home timelines: GET /posts with many uids
+
+    instead of one $in over every author, sorted as a whole and skipped, each
+    author is read with its own range scan over the (uid, timestamp, _id)
+    index, TIMELINE_FETCH posts at a time, all of them concurrently, and the
+    newest-first runs are k-way merged until the page is full. an author is
+    only read further when its whole run made it into the page, so the work
+    depends on the page size and the number of authors, not on how many
+    posts they have.
+
+    the newest run of every author is cached for TIMELINE_HEADS_TTL seconds
+    (0 disables it) and dropped when the author posts or deletes on this pod.
+'''
+MIN_AUTHORS = int(os.environ.get("TIMELINE_MIN_AUTHORS", 2))
+FETCH = int(os.environ.get("TIMELINE_FETCH", 20)) # posts per author range scan
+WORKERS = int(os.environ.get("TIMELINE_WORKERS", 16))
+
+# own pool: the timeline is read from a db worker thread, waiting on that same pool could deadlock it
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="posts-timeline")
+
+heads = cache.LRUCache(
+    "timeline_heads",
+    maxsize=int(os.environ.get("TIMELINE_HEADS", 10000)),
+    ttl=float(os.environ.get("TIMELINE_HEADS_TTL", 2)),
+)
+
+
+def newest_first(doc: Dict[str, Any]) -> Tuple[datetime, ObjectId]:
+    return doc['timestamp'], doc['_id']
+
+
+def fetch(uid: str, private: bool, blocked: bool, after: Optional[tuple] = None) -> List[Dict[str, Any]]:
+    # up to FETCH posts/snapshares of `uid` older than `after` (timestamp, _id)
+    query = {'uid': uid}
+    if not private:
+        query['is_private'] = False
+    if not blocked:
+        query['is_blocked'] = False
+    if after:
+        timestamp, oid = after
+        query['$or'] = [{'timestamp': {'$lt': timestamp}}, {'timestamp': timestamp, '_id': {'$lt': oid}}]
+    found = relaxed_collection(BasePost).find(query).sort([('timestamp', -1), ('_id', -1)]).limit(FETCH)
+    return list(found)
+
+
+def head(uid: str, private: bool, blocked: bool) -> List[Dict[str, Any]]:
+    if not heads.ttl:
+        return fetch(uid, private, blocked)
+    return heads.get((uid, private, blocked), lambda key: fetch(*key))
+
+
+def forget(*uids: str):
+    # an author posted or deleted something, its cached runs are stale
+    heads.invalidate(*((uid, private, blocked) for uid in uids for private in (False, True) for blocked in (False, True)))
+
+
+def concurrently(fn, args: Iterable[tuple]) -> list:
+    # each call runs in a copy of the caller context (request instrumentation)
+    futures = [executor.submit(copy_context().run, fn, *arg) for arg in args]
+    return [future.result() for future in futures]
+
+
+def read(uids: List[str], private: bool, blocked: bool, limit: int, after: Optional[tuple] = None) -> List[Dict[str, Any]]:
+    '''
+        newest `limit` posts and snapshares of `uids` after the (timestamp, _id)
+        keyset `after`. returned documents are copies, callers may modify them
+    '''
+    uids = list(dict.fromkeys(uids))
+    if after is None:
+        runs = concurrently(head, ((uid, private, blocked) for uid in uids))
+    else:
+        runs = concurrently(fetch, ((uid, private, blocked, after) for uid in uids))
+    runs = dict(zip(uids, runs))
+    more = {uid for uid, run in runs.items() if len(run) == FETCH} # may have older posts
+
+    while True:
+        page = list(islice(heapq.merge(*runs.values(), key=newest_first, reverse=True), limit))
+        in_page = {doc['_id'] for doc in page}
+        # authors whose last fetched post is in the page: their next ones may belong to it too
+        behind = [uid for uid in more if runs[uid][-1]['_id'] in in_page]
+        if not behind:
+            return [dict(doc) for doc in page]
+        older = concurrently(fetch, ((uid, private, blocked, newest_first(runs[uid][-1])) for uid in behind))
+        for uid, run in zip(behind, older):
+            runs[uid] = runs[uid] + run # new list, cached runs are shared
+            if len(run) < FETCH:
+                more.discard(uid)
@@ -0,0 +1,118 @@
+from .database import relaxed
+from .models import TopicBucket
+from pymongo import UpdateOne
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Iterable, Tuple
+import math
+import os
+import threading
+import time
+
+'''
+    trending topics engine
+
+    every mention is an atomic $inc on a per-minute (topic, bucket) counter,
+    so posting costs one upsert per hashtag no matter how viral it is. the
+    ranking is an exponentially decayed sum of the buckets in the window,
+    computed by one aggregation and kept in memory as a top-K list that is
+    refreshed at most every TRENDING_REFRESH seconds. every refresh bumps an
+    epoch, rendered /trendings pages are cached per epoch (see crud).
+'''
+WINDOW = timedelta(hours=24) # same as the buckets ttl
+HALF_LIFE = timedelta(hours=int(os.environ.get("TRENDING_HALF_LIFE_HOURS", 6)))
+TOP_K = int(os.environ.get("TRENDING_TOP_K", 1000))
+REFRESH = float(os.environ.get("TRENDING_REFRESH", 30)) # seconds
+
+_lock = threading.Lock()
+_top: List[Dict[str, Any]] = []
+_rank: Dict[str, int] = {} # topic -> position in _top
+_refreshed_at = None # time.monotonic() of the last refresh
+_ranking: Tuple[int, List[Dict[str, Any]]] = (0, []) # (epoch, _top), replaced as a whole
+
+
+def bucket_of(timestamp: datetime) -> datetime:
+    # start of the minute
+    return timestamp.replace(second=0, microsecond=0)
+
+
+def record_mentions(hashtags: Iterable[str], timestamp: datetime = None):
+    '''
+        add one mention per hashtag (repeated hashtags are summed) with a
+        single unordered bulk of upserts. a Counter of hashtag -> mentions is
+        accepted as well
+    '''
+    counts = Counter(hashtags)
+    if not counts:
+        return
+    bucket = bucket_of(timestamp or datetime.utcnow())
+    ops = [
+        UpdateOne({'topic': topic, 'bucket': bucket}, {'$inc': {'count': n}}, upsert=True)
+        for topic, n in counts.items()
+    ]
+    TopicBucket._get_collection().bulk_write(ops, ordered=False)
+
+
+def remove_mentions(mentions: Iterable[Tuple[str, datetime]]):
+    '''
+        take back the (hashtag, post timestamp) mentions of deleted posts with
+        one bulk of $inc. only buckets still inside the window are touched
+    '''
+    since = datetime.utcnow() - WINDOW
+    counts = Counter((topic, bucket_of(timestamp)) for topic, timestamp in mentions if timestamp >= since)
+    if not counts:
+        return
+    ops = [
+        UpdateOne({'topic': topic, 'bucket': bucket}, {'$inc': {'count': -n}})
+        for (topic, bucket), n in counts.items()
+    ]
+    TopicBucket._get_collection().bulk_write(ops, ordered=False)
+
+
+def compute_top(now: datetime = None) -> List[Dict[str, Any]]:
+    now = now or datetime.utcnow()
+    rate = math.log(2) / (HALF_LIFE / timedelta(milliseconds=1)) # decay per ms of age
+    pipeline = [
+        {'$match': {'bucket': {'$gte': now - WINDOW}}},
+        {'$group': {
+            '_id': '$topic',
+            'mention_count': {'$sum': '$count'},
+            'score': {'$sum': {'$multiply': [
+                '$count', {'$exp': {'$multiply': [-rate, {'$subtract': [now, '$bucket']}]}}
+            ]}},
+        }},
+        {'$sort': {'score': -1, '_id': 1}},
+        {'$limit': TOP_K},
+    ]
+    return [
+        {'topic': row['_id'], 'mention_count': row['mention_count']}
+        for row in relaxed(TopicBucket.objects).aggregate(pipeline)
+    ]
+
+
+def top_topics(max_age: float = REFRESH) -> List[Dict[str, Any]]:
+    '''
+        current top-K, ordered by (-score, topic). only one thread recomputes
+        it when it is older than `max_age`, the rest wait and reuse the result
+    '''
+    global _top, _rank, _refreshed_at, _ranking
+    if _refreshed_at is None or time.monotonic() - _refreshed_at > max_age:
+        with _lock:
+            if _refreshed_at is None or time.monotonic() - _refreshed_at > max_age:
+                _top = compute_top()
+                _rank = {row['topic']: i for i, row in enumerate(_top)}
+                _refreshed_at = time.monotonic()
+                _ranking = (_ranking[0] + 1, _top)
+    return _top
+
+
+def ranking(max_age: float = REFRESH) -> Tuple[int, List[Dict[str, Any]]]:
+    # current top-K with its refresh epoch, read together
+    top_topics(max_age)
+    return _ranking
+
+
+def position_after(topic: str, default: int) -> int:
+    # index right after `topic` in the current top-K (`default` if it dropped out)
+    rank = _rank.get(topic)
+    return default if rank is None else rank + 1